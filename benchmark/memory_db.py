@@ -0,0 +1,225 @@
+# In-process stand-in for the parts of MongoClient that myscript.py uses,
+# so the pipeline runs without a database server.
+from bson import ObjectId
+from pymongo import InsertOne, UpdateOne
+
+
+def get_field(doc, name):
+    """
+    Value of a dotted field name, or None.
+    :param doc:
+    :param name: e.g. 'provenance.image.case_id'
+    :return:
+    """
+    for part in name.split('.'):
+        if not isinstance(doc, dict) or part not in doc:
+            return None
+        doc = doc[part]
+    return doc
+
+
+def matches(doc, filter_q):
+    """
+    Equality match on every (dotted) field of the filter; no query operators.
+    :param doc:
+    :param filter_q:
+    :return:
+    """
+    return all(get_field(doc, name) == value for name, value in (filter_q or {}).items())
+
+
+def project(doc, projection):
+    """
+    Inclusion projection of (dotted) fields; _id is kept unless set to 0.
+    :param doc:
+    :param projection:
+    :return:
+    """
+    if not projection:
+        return dict(doc)
+    rtn_obj = {}
+    if projection.get('_id', 1) and '_id' in doc:
+        rtn_obj['_id'] = doc['_id']
+    for name, include in projection.items():
+        if name == '_id' or not include:
+            continue
+        value = get_field(doc, name)
+        if value is None:
+            continue
+        parts = name.split('.')
+        target = rtn_obj
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return rtn_obj
+
+
+class MemoryCursor(object):
+    """
+    List-backed cursor with sort and limit.
+    """
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, key, direction=1):
+        self.docs = sorted(self.docs, key=lambda doc: get_field(doc, key), reverse=direction < 0)
+        return self
+
+    def limit(self, n):
+        if n:
+            self.docs = self.docs[:n]
+        return self
+
+    def __iter__(self):
+        return iter(self.docs)
+
+
+class BulkResult(object):
+    """
+    The counts of pymongo's BulkWriteResult that PatchWriter reads.
+    """
+
+    def __init__(self):
+        self.inserted_count = 0
+        self.matched_count = 0
+        self.modified_count = 0
+        self.upserted_count = 0
+
+
+class MemoryCollection(object):
+    """
+    Documents in a list. Upserts whose filter has exactly the fields of the
+    last create_index are looked up in a dict, like an index on a real server.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.docs = []
+        self.index_fields = None
+        self.index = {}
+
+    def index_key(self, filter_q):
+        if self.index_fields and sorted(filter_q) == sorted(self.index_fields):
+            return tuple(filter_q[name] for name in self.index_fields)
+        return None
+
+    def create_index(self, keys, **kwargs):
+        self.index_fields = [name for name, _ in keys]
+        self.index = {}
+        for doc in self.docs:
+            self.index[tuple(get_field(doc, name) for name in self.index_fields)] = doc
+        return '_'.join('{}_{}'.format(name, direction) for name, direction in keys)
+
+    def insert_one(self, doc):
+        doc.setdefault('_id', ObjectId())
+        self.docs.append(dict(doc))
+        if self.index_fields:
+            self.index[tuple(get_field(doc, name) for name in self.index_fields)] = self.docs[-1]
+
+    def insert_many(self, docs, ordered=True):
+        for doc in docs:
+            self.insert_one(doc)
+
+    def update_one(self, filter_q, update, upsert=False):
+        """
+        $set update of the first matching document.
+        :param filter_q:
+        :param update: {'$set': fields}
+        :param upsert:
+        :return: 'matched', 'upserted' or None
+        """
+        key = self.index_key(filter_q)
+        if key is not None:
+            doc = self.index.get(key)
+        else:
+            doc = next((doc for doc in self.docs if matches(doc, filter_q)), None)
+        if doc is not None:
+            doc.update(update['$set'])
+            return 'matched'
+        if upsert:
+            doc = dict(filter_q)
+            doc.update(update['$set'])
+            self.insert_one(doc)
+            return 'upserted'
+        return None
+
+    def bulk_write(self, requests, ordered=True):
+        """
+        Apply InsertOne and UpdateOne requests.
+        :param requests:
+        :param ordered:
+        :return:
+        """
+        result = BulkResult()
+        for request in requests:
+            # pymongo keeps the request arguments in these attributes
+            if isinstance(request, InsertOne):
+                self.insert_one(dict(request._doc))
+                result.inserted_count += 1
+            elif isinstance(request, UpdateOne):
+                outcome = self.update_one(request._filter, request._doc, request._upsert)
+                if outcome == 'matched':
+                    result.matched_count += 1
+                    result.modified_count += 1
+                elif outcome == 'upserted':
+                    result.upserted_count += 1
+            else:
+                raise NotImplementedError(type(request).__name__)
+        return result
+
+    def find(self, filter_q=None, projection=None):
+        return MemoryCursor([project(doc, projection) for doc in self.docs if matches(doc, filter_q)])
+
+    def count_documents(self, filter_q):
+        return sum(1 for doc in self.docs if matches(doc, filter_q))
+
+    def delete_many(self, filter_q):
+        self.docs = [doc for doc in self.docs if not matches(doc, filter_q)]
+        if self.index_fields:
+            self.create_index([(name, 1) for name in self.index_fields])
+
+
+class MemoryDatabase(object):
+    """
+    Collections by item or attribute, created on first use.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(name)
+        return self.collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return self[name]
+
+
+class MemoryClient(object):
+    """
+    Databases by item or attribute, created on first use.
+    """
+
+    def __init__(self):
+        self.databases = {}
+
+    def __getitem__(self, name):
+        if name not in self.databases:
+            self.databases[name] = MemoryDatabase(name)
+        return self.databases[name]
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return self[name]
+
+    def server_info(self):
+        return {'version': 'memory'}
+
+    def close(self):
+        pass
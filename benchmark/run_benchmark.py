@@ -0,0 +1,271 @@
+# Offline benchmark of myscript.py: synthetic slides at several scales, run against an
+# in-memory database stand-in (or a scratch MongoDB server with --db_host), with per-stage
+# timings from --metrics_file compared to a stored baseline.
+#   python benchmark/run_benchmark.py --scales small medium --repeat 3
+#   python benchmark/run_benchmark.py --save_baseline
+#   python benchmark/run_benchmark.py -- --workers 4 -p 256 512
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import myscript  # noqa: E402
+import synthetic  # noqa: E402
+
+
+def get_case_id(scale):
+    """
+    :param scale:
+    :return: case ID of the synthetic slide for a scale
+    """
+    return 'BENCH_' + scale
+
+
+def prepare_slides(scales, seed):
+    """
+    Generate the synthetic slide of every scale that isn't on disk yet.
+    :param scales:
+    :param seed:
+    :return:
+    """
+    for scale in scales:
+        start_time = time.time()
+        generated = synthetic.ensure_slide(os.path.join(WORK_DIR, get_case_id(scale)), get_case_id(scale),
+                                           USER_NAME + '_Tumor_Region', SCALES[scale], seed,
+                                           os.path.join(REPO_DIR, 'config', 'dtypes.list'))
+        if generated:
+            print('Generated {} in {:.1f}s'.format(get_case_id(scale), time.time() - start_time))
+
+
+def clear_caches(case_id):
+    """
+    Remove what an earlier run left behind, so every run starts cold: markup, feature
+    and tile manifest caches, checkpoints and area reports.
+    :param case_id:
+    :return:
+    """
+    shutil.rmtree(os.path.join(WORK_DIR, 'markup_cache'), ignore_errors=True)
+    shutil.rmtree(os.path.join(WORK_DIR, 'feature_cache'), ignore_errors=True)
+    slide_dir = os.path.join(WORK_DIR, case_id)
+    for name in os.listdir(slide_dir):
+        if name == 'tile_manifest.npz' or name.startswith('checkpoint_') or name.startswith('nucleus_area_report_'):
+            os.remove(os.path.join(slide_dir, name))
+
+
+def seed_database(case_id):
+    """
+    With --db_host: load the slide's tumor markups into quip.objects and remove the
+    slide's patch documents from earlier runs. Only documents of this case ID are touched.
+    :param case_id:
+    :return:
+    """
+    client = myscript.MongoClient('mongodb://' + DB_HOST + ':27017')
+    objects = client.quip.objects
+    objects.delete_many({'provenance.image.case_id': case_id})
+    with open(os.path.join(WORK_DIR, case_id, 'tumor_markups.json')) as f:
+        objects.insert_many(json.load(f))
+    f.close()
+    client.quip_comp[myscript.coll_name].delete_many({'case_id': case_id})
+    client.close()
+
+
+def run_once(scale, myscript_args):
+    """
+    Run one slide in a fresh process and return its metrics record (see Metrics.report).
+    :param scale:
+    :param myscript_args: extra myscript.py arguments
+    :return:
+    """
+    case_id = get_case_id(scale)
+    metrics_file = os.path.join(WORK_DIR, 'metrics.jsonl')
+    if os.path.exists(metrics_file):
+        os.remove(metrics_file)
+
+    cmd = [sys.executable, os.path.join(BENCH_DIR, 'run_slide.py'), '--work_dir', WORK_DIR]
+    if DB_HOST:
+        seed_database(case_id)
+        db_host = DB_HOST
+    else:
+        cmd += ['--memory_db', '--markups', os.path.join(WORK_DIR, case_id, 'tumor_markups.json')]
+        db_host = 'memory'
+    cmd += ['--', '-s', case_id, '-u', USER_NAME, '-b', db_host, '--log_level', 'warning',
+            '--metrics_file', metrics_file] + myscript_args
+
+    rc = subprocess.call(cmd)
+    if rc != 0 or not os.path.isfile(metrics_file):
+        print('Run of {} failed (exit status {})'.format(case_id, rc))
+        exit(1)
+    with open(metrics_file) as f:
+        record = json.loads(f.readlines()[-1])
+    f.close()
+    return record
+
+
+def median_record(records):
+    """
+    Per-field median of the numeric fields of several runs.
+    :param records:
+    :return:
+    """
+    rtn_obj = {}
+    for name, value in records[0].items():
+        if isinstance(value, (int, float)):
+            rtn_obj[name] = float(np.median([record[name] for record in records]))
+    return rtn_obj
+
+
+def compare(scale, current, baseline):
+    """
+    Regressions of one scale against the baseline: a stage (or the whole slide) slower by
+    more than TOLERANCE and MIN_SECONDS, peak memory up by more than TOLERANCE and MIN_MB,
+    or a different number of tiles, patches, nuclei or documents.
+    :param scale:
+    :param current: see median_record
+    :param baseline:
+    :return: list of messages
+    """
+    regressions = []
+    for name in ['seconds'] + [stage + '_seconds' for stage in myscript.METRIC_STAGES]:
+        old, new = baseline.get(name, 0.0), current.get(name, 0.0)
+        if new > old * (1 + TOLERANCE) and new - old > MIN_SECONDS:
+            regressions.append('{} {}: {:.3f}s -> {:.3f}s'.format(scale, name, old, new))
+    for name in ['peak_rss_mb', 'peak_rss_workers_mb']:
+        old, new = baseline.get(name, 0.0), current.get(name, 0.0)
+        if new > old * (1 + TOLERANCE) and new - old > MIN_MB:
+            regressions.append('{} {}: {:.0f} MB -> {:.0f} MB'.format(scale, name, old, new))
+    for name in myscript.METRIC_COUNTS:
+        if name in baseline and baseline[name] != current.get(name):
+            regressions.append('{} {}: {:.0f} -> {:.0f}'.format(scale, name, baseline[name], current.get(name, 0)))
+    return regressions
+
+
+def print_results(results):
+    """
+    Summary per scale, then seconds per stage.
+    :param results: {scale: median record}
+    :return:
+    """
+    scales = list(results)
+    print('{:<22}'.format('') + ''.join('{:>12}'.format(scale) for scale in scales))
+    rows = [('seconds', '{:.2f}'), ('patches', '{:.0f}'), ('nuclei', '{:.0f}'), ('patches_per_second', '{:.1f}'),
+            ('nuclei_per_second', '{:.0f}'), ('peak_rss_mb', '{:.0f}'), ('peak_rss_workers_mb', '{:.0f}')]
+    rows += [(stage + '_seconds', '{:.3f}') for stage in myscript.METRIC_STAGES]
+    for name, fmt in rows:
+        print('{:<22}'.format(name.replace('_seconds', '')) +
+              ''.join('{:>12}'.format(fmt.format(results[scale].get(name, 0.0))) for scale in scales))
+
+
+def main():
+    global WORK_DIR, DB_HOST, TOLERANCE, MIN_SECONDS, MIN_MB
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--scales", nargs='+', choices=list(SCALES), default=['small', 'medium'],
+                    help="slide sizes to run")
+    ap.add_argument("--repeat", type=int, default=3, help="runs per scale; the median is reported")
+    ap.add_argument("--warm", action="store_true",
+                    help="keep the markup, feature and manifest caches between runs (after one untimed run)")
+    ap.add_argument("--work_dir", default=os.path.join(BENCH_DIR, 'work'),
+                    help="where the synthetic slides are generated and run")
+    ap.add_argument("--db_host", help="scratch MongoDB server to use instead of the in-memory stand-in")
+    ap.add_argument("--seed", type=int, default=0, help="random seed of the synthetic slides")
+    ap.add_argument("--baseline", default=os.path.join(BENCH_DIR, 'baseline.json'), help="stored baseline")
+    ap.add_argument("--save_baseline", action="store_true", help="store these results as the baseline")
+    ap.add_argument("--tolerance", type=float, default=0.2, help="relative slowdown reported as a regression")
+    ap.add_argument("--min_seconds", type=float, default=0.05, help="ignore slowdowns smaller than this")
+    ap.add_argument("--min_mb", type=float, default=32.0, help="ignore peak memory increases smaller than this")
+    ap.add_argument("myscript_args", nargs=argparse.REMAINDER,
+                    help="-- then extra myscript.py arguments; -p defaults to {}".format(DEFAULT_ARGS[1]))
+    args = ap.parse_args()
+
+    WORK_DIR = os.path.abspath(args.work_dir)
+    DB_HOST = args.db_host
+    TOLERANCE = args.tolerance
+    MIN_SECONDS = args.min_seconds
+    MIN_MB = args.min_mb
+    myscript_args = [arg for arg in args.myscript_args if arg != '--']
+    if '-p' not in myscript_args and '--patch_size' not in myscript_args:
+        myscript_args = DEFAULT_ARGS + myscript_args
+
+    prepare_slides(args.scales, args.seed)
+
+    results = {}
+    for scale in args.scales:
+        case_id = get_case_id(scale)
+        if args.warm:
+            clear_caches(case_id)
+            run_once(scale, myscript_args)
+        records = []
+        for i in range(args.repeat):
+            if not args.warm:
+                clear_caches(case_id)
+            records.append(run_once(scale, myscript_args))
+            print('{} run {}: {:.2f}s'.format(scale, i + 1, records[-1]['seconds']))
+        results[scale] = median_record(records)
+
+    print_results(results)
+
+    baseline = None
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        f.close()
+
+    regressions = []
+    if baseline is None:
+        print('No baseline at {}; store one with --save_baseline'.format(args.baseline))
+    else:
+        if baseline['myscript_args'] != myscript_args or baseline['warm'] != args.warm:
+            print('Baseline was run with {} (warm: {}); comparing anyway'.format(
+                ' '.join(baseline['myscript_args']), baseline['warm']))
+        for scale in args.scales:
+            if scale in baseline['scales']:
+                if baseline['scales'][scale]['params'] != SCALES[scale]:
+                    print('Baseline {} slide had other parameters; skipping'.format(scale))
+                    continue
+                regressions.extend(compare(scale, results[scale], baseline['scales'][scale]['metrics']))
+        print('{} regressions against {} (tolerance {:.0%})'.format(len(regressions), args.baseline, TOLERANCE))
+        for message in regressions:
+            print('  ' + message)
+
+    if args.save_baseline:
+        scales = baseline['scales'] if baseline else {}
+        scales.update(dict((scale, {'params': SCALES[scale], 'metrics': results[scale]}) for scale in args.scales))
+        with open(args.baseline, 'w') as f:
+            json.dump({'created': datetime.now().isoformat(), 'platform': platform.platform(),
+                       'python': platform.python_version(), 'myscript_args': myscript_args, 'warm': args.warm,
+                       'repeat': args.repeat, 'scales': scales}, f, indent=2)
+        f.close()
+        print('Baseline saved to {}'.format(args.baseline))
+
+    exit(1 if regressions and not args.save_baseline else 0)
+
+
+# constant variables
+# Tiles across and down, tile side in pixels, nuclei per tile
+SCALES = {
+    'small': {'tiles_x': 2, 'tiles_y': 2, 'tile_size': 2048, 'nuclei': 600},
+    'medium': {'tiles_x': 4, 'tiles_y': 4, 'tile_size': 2048, 'nuclei': 1500},
+    'large': {'tiles_x': 8, 'tiles_y': 8, 'tile_size': 2048, 'nuclei': 3000},
+}
+USER_NAME = 'bench'
+DEFAULT_ARGS = ['-p', '512']
+
+# run-wide settings, see main()
+WORK_DIR = None
+DB_HOST = None
+TOLERANCE = 0.2
+MIN_SECONDS = 0.05
+MIN_MB = 32.0
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+# Run myscript.py on a slide in a benchmark work directory, against the in-memory
+# database stand-in (default) or a MongoDB server given with -b.
+# Used by run_benchmark.py, one process per run; arguments after -- go to myscript.py:
+#   python benchmark/run_slide.py --work_dir DIR --markups FILE -- -s CASE -u USER -p 512 [--memory_db]
+import argparse
+import json
+import os
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import myscript  # noqa: E402
+from memory_db import MemoryClient  # noqa: E402
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--work_dir", required=True, help="stands in for WORK_DIR")
+    ap.add_argument("--markups", help="tumor markup documents to load into the in-memory quip.objects")
+    ap.add_argument("--memory_db", action="store_true", help="use the in-memory database stand-in")
+    ap.add_argument("myscript_args", nargs=argparse.REMAINDER, help="-- then the myscript.py arguments")
+    args = ap.parse_args()
+
+    myscript_args = args.myscript_args
+    if myscript_args and myscript_args[0] == '--':
+        myscript_args = myscript_args[1:]
+
+    # myscript reads config/*.list relative to the repo
+    os.chdir(REPO_DIR)
+    myscript.WORK_DIR = os.path.abspath(args.work_dir)
+
+    if args.memory_db:
+        client = MemoryClient()
+        if args.markups:
+            with open(args.markups) as f:
+                client.quip.objects.insert_many(json.load(f))
+            f.close()
+        myscript.mongodb_connect = lambda client_uri: client
+
+    sys.argv = ['myscript.py'] + myscript_args
+    myscript.main()
+
+
+if __name__ == '__main__':
+    main()
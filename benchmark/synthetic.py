@@ -0,0 +1,295 @@
+# Synthetic slides for the benchmark: an Aperio-style tiled TIFF that OpenSlide opens as .svs,
+# per-tile JSON and *features.csv files with nucleus polygons, and tumor markups
+# in the quip.objects document format.
+import json
+import os
+import shutil
+
+import cv2
+import numpy as np
+import pandas
+import tifffile
+
+
+def get_feature_columns(dtypes_path):
+    """
+    *features.csv columns and numpy type names, from config/dtypes.list
+    (lines like "Perimeter: <type 'numpy.float64'>").
+    :param dtypes_path:
+    :return: list of (column, type name)
+    """
+    columns = []
+    with open(dtypes_path) as f:
+        for line in f:
+            name, _, type_str = line.strip().rpartition(': ')
+            if name:
+                columns.append((name, type_str.replace("<type '", '').replace("'>", '').replace('numpy.', '')))
+    f.close()
+    return columns
+
+
+def make_tissue_field(rng, width, height):
+    """
+    Smooth random field at 1/FIELD_SCALE of the slide; tissue is where it exceeds TISSUE_LEVEL.
+    :param rng:
+    :param width:
+    :param height:
+    :return:
+    """
+    coarse = rng.rand(height // (FIELD_SCALE * 8) + 2, width // (FIELD_SCALE * 8) + 2).astype(np.float32)
+    field = cv2.resize(coarse, (width // FIELD_SCALE, height // FIELD_SCALE), interpolation=cv2.INTER_CUBIC)
+    field = cv2.GaussianBlur(field, (0, 0), 4)
+    return (field - field.min()) / max(field.max() - field.min(), 1e-6)
+
+
+def make_nuclei(rng, field, tile_minx, tile_miny, tile_size, count):
+    """
+    Nucleus outlines inside the tissue of one tile: jittered ellipses of NUCLEUS_VERTICES points.
+    :param rng:
+    :param field: see make_tissue_field
+    :param tile_minx:
+    :param tile_miny:
+    :param tile_size:
+    :param count:
+    :return: (count, NUCLEUS_VERTICES, 2) float array of slide coordinates
+    """
+    # Rejection-sample centres that fall in tissue
+    centres = rng.uniform(0, tile_size, (count * 4, 2)) + [tile_minx, tile_miny]
+    cells = (centres // FIELD_SCALE).astype(np.int64)
+    cells[:, 0] = np.minimum(cells[:, 0], field.shape[1] - 1)
+    cells[:, 1] = np.minimum(cells[:, 1], field.shape[0] - 1)
+    centres = centres[field[cells[:, 1], cells[:, 0]] > TISSUE_LEVEL][:count]
+    n = len(centres)
+
+    angles = np.linspace(0, 2 * np.pi, NUCLEUS_VERTICES, endpoint=False)
+    angles = angles + rng.uniform(-0.15, 0.15, (n, NUCLEUS_VERTICES))
+    radius = rng.uniform(*NUCLEUS_RADIUS, size=(n, 1)) * rng.uniform(0.85, 1.15, (n, NUCLEUS_VERTICES))
+    elongation = rng.uniform(1.0, 1.6, (n, 1))
+    rotation = rng.uniform(0, np.pi, (n, 1))
+    dx = radius * elongation * np.cos(angles)
+    dy = radius / elongation * np.sin(angles)
+    x = centres[:, :1] + dx * np.cos(rotation) - dy * np.sin(rotation)
+    y = centres[:, 1:] + dx * np.sin(rotation) + dy * np.cos(rotation)
+    return np.round(np.stack([x, y], axis=2), 1)
+
+
+def polygon_strings(nuclei):
+    """
+    Polygon column values, "[x1:y1:x2:y2:...]", as written by the segmentation pipeline.
+    :param nuclei: see make_nuclei
+    :return:
+    """
+    flat = nuclei.reshape(len(nuclei), -1)
+    return ['[' + ':'.join(['{:.1f}'.format(value) for value in row]) + ']' for row in flat]
+
+
+def make_features(rng, nuclei, columns):
+    """
+    *features.csv rows: geometric columns from the outlines, the rest random.
+    :param rng:
+    :param nuclei: see make_nuclei
+    :param columns: see get_feature_columns
+    :return: DataFrame
+    """
+    x = nuclei[:, :, 0]
+    y = nuclei[:, :, 1]
+    area = 0.5 * np.abs(np.sum(x * np.roll(y, -1, axis=1) - np.roll(x, -1, axis=1) * y, axis=1))
+    perimeter = np.sum(np.hypot(np.roll(x, -1, axis=1) - x, np.roll(y, -1, axis=1) - y), axis=1)
+
+    data = {}
+    n = len(nuclei)
+    for name, type_name in columns:
+        if name == 'Polygon':
+            data[name] = polygon_strings(nuclei)
+        elif name == 'AreaInPixels':
+            data[name] = np.round(area).astype(np.int64)
+        elif name == 'Perimeter':
+            data[name] = perimeter
+        elif name == 'Circularity':
+            data[name] = 4 * np.pi * area / np.maximum(perimeter, 1e-6) ** 2
+        elif type_name.startswith('int'):
+            data[name] = rng.randint(0, 256, n)
+        elif type_name == 'str':
+            data[name] = [''] * n
+        else:
+            data[name] = rng.gamma(2.0, 10.0, n)
+    return pandas.DataFrame(data, columns=[name for name, _ in columns])
+
+
+def draw_band(rng, field, nuclei_rows, band_miny, width, band_height):
+    """
+    RGB pixels of one row of tiles: glass, stroma where the field says tissue, then nuclei.
+    :param rng:
+    :param field: see make_tissue_field
+    :param nuclei_rows: outline arrays (see make_nuclei) that may reach into the band
+    :param band_miny:
+    :param width:
+    :param band_height:
+    :return:
+    """
+    rows = field[band_miny // FIELD_SCALE:(band_miny + band_height) // FIELD_SCALE]
+    tissue = cv2.resize(rows, (width, band_height), interpolation=cv2.INTER_LINEAR) > TISSUE_LEVEL
+
+    band = np.empty((band_height, width, 3), dtype=np.uint8)
+    band[:] = GLASS_RGB
+    band[tissue] = STROMA_RGB
+    for nuclei in nuclei_rows:
+        if len(nuclei):
+            outlines = np.round(nuclei - [0, band_miny]).astype(np.int32)
+            # thickness -1 fills every outline on its own, so overlapping nuclei stay filled
+            cv2.drawContours(band, list(outlines), -1, NUCLEUS_RGB, -1)
+
+    noise = rng.randint(-PIXEL_NOISE, PIXEL_NOISE + 1, (band_height, width, 1)).astype(np.int16)
+    return np.clip(band + noise, 0, 255).astype(np.uint8)
+
+
+def make_markups(case_id, execution_id):
+    """
+    Two tumor outlines in normalized coordinates: a large ellipse and a small square in one corner,
+    as quip.objects documents.
+    :param case_id:
+    :param execution_id:
+    :return:
+    """
+    angles = np.linspace(0, 2 * np.pi, 64)
+    ellipse = np.column_stack([0.5 + 0.38 * np.cos(angles), 0.5 + 0.3 * np.sin(angles)])
+    square = np.array([[0.02, 0.02], [0.12, 0.02], [0.12, 0.12], [0.02, 0.12], [0.02, 0.02]])
+    return [{'provenance': {'image': {'case_id': case_id}, 'analysis': {'execution_id': execution_id}},
+             'geometry': {'type': 'Polygon', 'coordinates': [np.round(outline, 6).tolist()]}}
+            for outline in (ellipse, square)]
+
+
+def write_slide(path, bands, width, height):
+    """
+    Write an Aperio-style pyramid: the full-resolution image from bands, then
+    levels reduced by LEVEL_DOWNSAMPLE until the shorter side is below MIN_LEVEL_SIZE.
+    :param path:
+    :param bands: iterator of (band_height, width, 3) arrays, top to bottom
+    :param width:
+    :param height:
+    :return:
+    """
+    levels = []
+    size = (width, height)
+    while min(size) // LEVEL_DOWNSAMPLE >= MIN_LEVEL_SIZE:
+        size = (size[0] // LEVEL_DOWNSAMPLE, size[1] // LEVEL_DOWNSAMPLE)
+        levels.append([])
+
+    def level0_tiles():
+        for band in bands:
+            reduced = band
+            for level_bands in levels:
+                reduced = cv2.resize(reduced, (reduced.shape[1] // LEVEL_DOWNSAMPLE,
+                                               reduced.shape[0] // LEVEL_DOWNSAMPLE), interpolation=cv2.INTER_AREA)
+                level_bands.append(reduced)
+            for tile_y in range(0, band.shape[0], TIFF_TILE):
+                for tile_x in range(0, width, TIFF_TILE):
+                    yield band[tile_y:tile_y + TIFF_TILE, tile_x:tile_x + TIFF_TILE]
+
+    description = ('Aperio Image Library v10.0.0\n{w}x{h} [0,0 {w}x{h}] ({t}x{t}) RGB|AppMag = 40|MPP = {mpp}'
+                   .format(w=width, h=height, t=TIFF_TILE, mpp=MPP))
+    with tifffile.TiffWriter(path, bigtiff=True) as tif:
+        tif.write(level0_tiles(), shape=(height, width, 3), dtype=np.uint8, tile=(TIFF_TILE, TIFF_TILE),
+                  photometric='rgb', compression='zlib', description=description, metadata=None)
+        for level_bands in levels:
+            tif.write(np.concatenate(level_bands), tile=(TIFF_TILE, TIFF_TILE), photometric='rgb',
+                      compression='zlib', metadata=None)
+
+
+def make_slide(slide_dir, case_id, execution_id, tiles_x, tiles_y, tile_size, nuclei, seed, dtypes_path):
+    """
+    Write a synthetic slide into slide_dir (the layout copy_src_data leaves in WORK_DIR/case_id):
+    <case_id>.svs, one feature subfolder with <prefix>-algmeta.json and <prefix>-features.csv per
+    tile, and tumor_markups.json holding the quip.objects documents to load into the database.
+    :param slide_dir:
+    :param case_id:
+    :param execution_id: markup execution_id, <user>_Tumor_Region
+    :param tiles_x: tiles across
+    :param tiles_y: tiles down
+    :param tile_size: tile side in pixels, a multiple of TIFF_TILE * LEVEL_DOWNSAMPLE ** 2
+    :param nuclei: nuclei per tile (fewer where a tile has little tissue)
+    :param seed:
+    :param dtypes_path: config/dtypes.list
+    :return:
+    """
+    rng = np.random.RandomState(seed)
+    width, height = tiles_x * tile_size, tiles_y * tile_size
+    columns = get_feature_columns(dtypes_path)
+    feature_dir = os.path.join(slide_dir, FEATURE_FOLDER)
+    os.makedirs(feature_dir)
+
+    field = make_tissue_field(rng, width, height)
+    nuclei_rows = []
+    for row in range(tiles_y):
+        row_nuclei = []
+        for col in range(tiles_x):
+            tile_minx, tile_miny = col * tile_size, row * tile_size
+            outlines = make_nuclei(rng, field, tile_minx, tile_miny, tile_size, nuclei)
+            row_nuclei.append(outlines)
+
+            prefix = '{}_x{}_y{}'.format(case_id, tile_minx, tile_miny)
+            with open(os.path.join(feature_dir, prefix + '-algmeta.json'), 'w') as f:
+                json.dump({'tile_minx': tile_minx, 'tile_miny': tile_miny, 'tile_width': tile_size,
+                           'tile_height': tile_size, 'image_width': width, 'image_height': height,
+                           'out_file_prefix': prefix}, f)
+            f.close()
+            make_features(rng, outlines, columns).to_csv(os.path.join(feature_dir, prefix + '-features.csv'),
+                                                         index=False)
+        nuclei_rows.append(np.concatenate(row_nuclei))
+
+    def bands():
+        for row in range(tiles_y):
+            yield draw_band(rng, field, nuclei_rows[max(row - 1, 0):row + 2], row * tile_size, width, tile_size)
+
+    write_slide(os.path.join(slide_dir, case_id + '.svs'), bands(), width, height)
+
+    with open(os.path.join(slide_dir, 'tumor_markups.json'), 'w') as f:
+        json.dump(make_markups(case_id, execution_id), f)
+    f.close()
+
+
+def ensure_slide(slide_dir, case_id, execution_id, params, seed, dtypes_path):
+    """
+    make_slide, unless slide_dir already holds a slide generated with the same parameters.
+    :param slide_dir:
+    :param case_id:
+    :param execution_id:
+    :param params: dict with tiles_x, tiles_y, tile_size, nuclei
+    :param seed:
+    :param dtypes_path:
+    :return: True if the slide was (re)generated
+    """
+    stamp = dict(params, case_id=case_id, execution_id=execution_id, seed=seed, version=GENERATOR_VERSION)
+    stamp_path = os.path.join(slide_dir, 'synthetic.json')
+    if os.path.isfile(stamp_path):
+        with open(stamp_path) as f:
+            if json.load(f) == stamp:
+                return False
+        f.close()
+
+    shutil.rmtree(slide_dir, ignore_errors=True)
+    make_slide(slide_dir, case_id, execution_id, params['tiles_x'], params['tiles_y'], params['tile_size'],
+               params['nuclei'], seed, dtypes_path)
+    with open(stamp_path, 'w') as f:
+        json.dump(stamp, f)
+    f.close()
+    return True
+
+
+# constant variables
+# Bump when the generated data changes, so existing slides are rebuilt
+GENERATOR_VERSION = 1
+FEATURE_FOLDER = 'synthetic'
+TIFF_TILE = 256
+LEVEL_DOWNSAMPLE = 4
+MIN_LEVEL_SIZE = 512
+MPP = 0.25
+FIELD_SCALE = 16
+TISSUE_LEVEL = 0.35
+# Nucleus radius range in pixels at MPP
+NUCLEUS_RADIUS = (7.0, 16.0)
+NUCLEUS_VERTICES = 12
+GLASS_RGB = (236, 233, 240)
+STROMA_RGB = (222, 160, 196)
+NUCLEUS_RGB = (112, 72, 150)
+PIXEL_NOISE = 12
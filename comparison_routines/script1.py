@@ -48,7 +48,9 @@ def get_data():
     for doc in bridge.find({'case_id': case_id}):
         x = doc['patch_min_x_pixel']
         y = doc['patch_min_y_pixel']
-        items = me.find_one({'patch_min_x_pixel': x, 'patch_min_y_pixel': y})
+        # Several patch sizes share the same origins; myscript.py stores patch_size as an int
+        items = me.find_one({'case_id': case_id, 'patch_size': int(patch_size), 'patch_min_x_pixel': x,
+                             'patch_min_y_pixel': y})
         if items is not None:
             row_vals = [case_id, patch_size, x, y]
             start = len(row_vals)
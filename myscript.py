@@ -1,12 +1,24 @@
 # Compute patch-level nuclear feature results.
 # Tumor-region only.
-# Change coll_name on line 830 to write to quip_comp.[your_collection_name]
+# Change coll_name under the constant variables to write to quip_comp.[your_collection_name]
 import argparse
+import atexit
+import hashlib
 import json
+import logging
+import math
+import multiprocessing
 import os
+import re
+import resource
+import shutil
 import subprocess
 import sys
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
 
@@ -15,8 +27,10 @@ import numpy as np
 import openslide
 import pandas
 # from planar import BoundingBox, Vec2
-from pymongo import MongoClient, errors
-from shapely.geometry import Polygon, Point, MultiPoint
+from pymongo import ASCENDING, MongoClient, UpdateOne, errors
+from shapely.geometry import Polygon, Point, MultiPoint, box
+from shapely.ops import unary_union
+from shapely.prepared import prep
 from skimage.color import separate_stains, hed_from_rgb
 
 
@@ -41,7 +55,7 @@ def mongodb_connect(client_uri):
     try:
         return MongoClient(client_uri, serverSelectionTimeoutMS=1)
     except errors.ConnectionFailure:
-        print("Failed to connect to server {}".format(client_uri))
+        LOG.error('Failed to connect to server %s', client_uri)
         exit(1)
 
 
@@ -53,82 +67,389 @@ def get_file_list(substr, filepath):
     :param filepath:
     :return:
     """
-    lines = []
-    with open(filepath) as f:
-        for line in f:
-            line = line.strip()
-            if substr in line:
-                lines.append(line)
-    f.close()
-    return lines
+    if filepath not in CONFIG_LINES:
+        # Config lists are read once per process
+        with open(filepath) as f:
+            CONFIG_LINES[filepath] = [line.strip() for line in f]
+        f.close()
+    return [line for line in CONFIG_LINES[filepath] if substr in line]
 
 
-def copy_src_data(dest):
+def copy_src_data(dest, case_id=None):
     """
     Copy data from nfs location to computation node.
+    The per-subfolder rsyncs and the slide copy run in parallel.
     :param dest:
+    :param case_id: defaults to CASE_ID
     :return:
     """
+    case_id = case_id or CASE_ID
+    jobs = []
+    pool = ThreadPoolExecutor(max_workers=max(RSYNC_JOBS, 1))
+
     # Get list of csv files containing features for this case_id
-    for csv_dir1 in DATA_FILE_SUBFOLDERS:
+    for csv_dir1 in get_file_list(case_id, 'config/data_file_path.list'):
         source_dir = os.path.join(DATA_FILE_FOLDER, csv_dir1)
         # copy all *.json and *features.csv files
         m_args = list(["rsync", "-ar", "--include", "*features.csv", "--include", "*.json"])
         # m_args = list(["rsync", "-avz", "--include", "*features.csv", "--include", "*.json"])
         m_args.append(source_dir)
         m_args.append(dest)
-        print("executing " + ' '.join(m_args))
-        subprocess.call(m_args)
+        LOG.info('executing %s', ' '.join(m_args))
+        jobs.append(pool.submit(subprocess.call, m_args))
 
     # Get slide
-    my_file = Path(os.path.join(dest, (CASE_ID + '.svs')))
+    my_file = Path(os.path.join(dest, (case_id + '.svs')))
     if not my_file.is_file():
-        svs_list = get_file_list(CASE_ID, 'config/image_path.list')
+        svs_list = get_file_list(case_id, 'config/image_path.list')
         svs_path = os.path.join(SVS_IMAGE_FOLDER, svs_list[0])
-        print("executing scp", svs_path, dest)
-        subprocess.check_call(['scp', svs_path, dest])
+        LOG.info('executing scp %s %s', svs_path, dest)
+        jobs.append(pool.submit(subprocess.check_call, ['scp', svs_path, dest]))
+
+    try:
+        for job in jobs:
+            job.result()  # re-raises a failed scp
+    finally:
+        pool.shutdown()
+
+
+def dir_size(path):
+    """
+    Total size in bytes of the files under path.
+    :param path:
+    :return:
+    """
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class Metrics(object):
+    """
+    Wall-clock seconds per pipeline stage, and counters, for one slide (or
+    one tile in a pool worker; see run_tile). Timers nest: time spent in an
+    inner stage is not counted in the outer one, so stages add up.
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.counts = {}
+        self.peaks = {}
+        self.stack = []
+
+    @contextmanager
+    def timer(self, stage):
+        """
+        Time the enclosed block as stage.
+        :param stage:
+        :return:
+        """
+        start = time.time()
+        self.stack.append(stage)
+        try:
+            yield
+        finally:
+            self.stack.pop()
+            elapsed = time.time() - start
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + elapsed
+            if self.stack:
+                self.seconds[self.stack[-1]] = self.seconds.get(self.stack[-1], 0.0) - elapsed
+
+    def count(self, name, n=1):
+        """
+        Add n to counter name.
+        :param name:
+        :param n:
+        :return:
+        """
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def peak(self, name, value):
+        """
+        Keep the largest value seen for name.
+        :param name:
+        :param value:
+        :return:
+        """
+        self.peaks[name] = max(self.peaks.get(name, value), value)
+
+    def merge(self, other):
+        """
+        Add the stage times and counters of other (e.g. a worker's tile) to these.
+        :param other:
+        :return:
+        """
+        for stage, seconds in other.seconds.items():
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        for name, n in other.counts.items():
+            self.count(name, n)
+        for name, value in other.peaks.items():
+            self.peak(name, value)
+
+    def report(self, case_id, seconds, peak_scope):
+        """
+        Per-slide record: stage seconds, counters, throughput and peak memory.
+        With --workers, stage seconds are summed over the workers.
+        :param case_id:
+        :param seconds: wall-clock seconds of the slide
+        :param peak_scope: 'slide' if peak_rss_mb covers this slide only, 'process' if the process lifetime
+        :return:
+        """
+        rtn_obj = {'case_id': case_id, 'seconds': round(seconds, 3), 'peak_rss_mb': round(get_peak_rss_mb(), 1),
+                   'peak_rss_workers_mb': round(self.peaks.get('rss_workers_mb', 0.0), 1),
+                   'peak_rss_scope': peak_scope}
+        for stage in METRIC_STAGES:
+            rtn_obj[stage + '_seconds'] = round(self.seconds.get(stage, 0.0), 3)
+        for name in METRIC_COUNTS:
+            rtn_obj[name] = self.counts.get(name, 0)
+        rtn_obj['patches_per_second'] = round(rtn_obj['patches'] / seconds, 2) if seconds else 0.0
+        rtn_obj['nuclei_per_second'] = round(rtn_obj['nuclei'] / seconds, 2) if seconds else 0.0
+        return rtn_obj
+
+
+def reset_peak_rss():
+    """
+    Restart the kernel's count of this process's peak RSS (VmHWM), so that
+    get_peak_rss_mb covers what follows. Linux only.
+    :return: True if the count was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        f.close()
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def get_peak_rss_mb():
+    """
+    Peak RSS of this process in MB, since the last reset_peak_rss; the
+    process-lifetime peak (ru_maxrss) where /proc isn't available.
+    :return:
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+        f.close()
+    except (IOError, OSError):
+        pass
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def write_metrics(record):
+    """
+    Append a slide's metrics to METRICS_FILE: a CSV row if the name ends in
+    .csv, else one JSON object per line.
+    :param record: see Metrics.report
+    :return:
+    """
+    if not METRICS_FILE:
+        return
+    assure_path_exists(METRICS_FILE)
+    if METRICS_FILE.endswith('.csv'):
+        fields = list(record.keys())
+        new_file = not os.path.isfile(METRICS_FILE) or os.path.getsize(METRICS_FILE) == 0
+        with open(METRICS_FILE, 'a') as f:
+            if new_file:
+                f.write(','.join(fields) + '\n')
+            f.write(','.join(str(record[field]) for field in fields) + '\n')
+    else:
+        with open(METRICS_FILE, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+def log_metrics(record):
+    """
+    Log the per-slide metrics summary.
+    :param record: see Metrics.report
+    :return:
+    """
+    LOG.info('Slide %s: %.1fs, %s tiles (%s failed), %s patches (%.1f/s), %s nuclei (%.1f/s), '
+             'peak RSS %.0f MB (workers %.0f MB)', record['case_id'], record['seconds'], record['tiles'],
+             record['tiles_failed'], record['patches'], record['patches_per_second'], record['nuclei'],
+             record['nuclei_per_second'], record['peak_rss_mb'], record['peak_rss_workers_mb'])
+    LOG.info('Stages: %s', ', '.join('{} {:.1f}s'.format(stage, record[stage + '_seconds'])
+                                     for stage in METRIC_STAGES if record[stage + '_seconds']))
+
+
+class Stager(object):
+    """
+    Copies slides into WORK_DIR from a background thread, in order, while
+    earlier slides compute. At most `ahead` slides are staged and not yet
+    released, and no new slide is started while WORK_DIR is over max_bytes
+    (unless nothing else is staged, so the batch can't stall).
+    """
+
+    def __init__(self, case_ids, ahead, max_bytes=None):
+        """
+        :param case_ids: slides, in the order they will be needed
+        :param ahead:
+        :param max_bytes:
+        """
+        self.case_ids = list(case_ids)
+        self.ahead = max(ahead, 1)
+        self.max_bytes = max_bytes
+        self.cond = threading.Condition()
+        self.staged = {}  # case_id -> None, or the staging error
+        self.seconds = {}  # case_id -> seconds spent copying
+        self.in_use = set()  # staging or staged, and not yet released
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def over_limit(self):
+        return self.max_bytes is not None and dir_size(WORK_DIR) >= self.max_bytes
+
+    def run(self):
+        for case_id in self.case_ids:
+            with self.cond:
+                while len(self.in_use) >= self.ahead or (self.in_use and self.over_limit()):
+                    self.cond.wait(5.0)
+                self.in_use.add(case_id)
+
+            error = None
+            start_time = time.time()
+            try:
+                dest = os.path.join(WORK_DIR, case_id) + os.sep
+                assure_path_exists(dest)
+                copy_src_data(dest, case_id)
+            except Exception as err:
+                error = 'staging {}: {}'.format(type(err).__name__, err)
+
+            with self.cond:
+                self.seconds[case_id] = time.time() - start_time
+                self.staged[case_id] = error
+                self.cond.notify_all()
+
+    def wait(self, case_id):
+        """
+        Block until case_id is staged.
+        :param case_id:
+        :return: None, or the staging error
+        """
+        with self.cond:
+            while case_id not in self.staged:
+                self.cond.wait()
+            return self.staged[case_id]
+
+    def release(self, case_id, cleanup=False):
+        """
+        The slide is finished; optionally delete its staged copy.
+        :param case_id:
+        :param cleanup:
+        :return:
+        """
+        if cleanup:
+            shutil.rmtree(os.path.join(WORK_DIR, case_id), ignore_errors=True)
+        with self.cond:
+            self.in_use.discard(case_id)
+            self.cond.notify_all()
+
+
+def get_markup_cache_path(execution_id):
+    """
+    Local cache file of the tumor markups for (CASE_ID, execution_id).
+    :param execution_id:
+    :return:
+    """
+    return os.path.join(MARKUP_CACHE_DIR, '{}__{}.json'.format(CASE_ID, execution_id))
+
+
+def read_markup_cache(execution_id):
+    """
+    :param execution_id:
+    :return: cached {'count', 'latest', 'markups'}, or None
+    """
+    cache_path = get_markup_cache_path(execution_id)
+    if not os.path.isfile(cache_path):
+        return None
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+        f.close()
+        return cached
+    except (OSError, ValueError) as err:
+        LOG.warning('Ignoring unreadable markup cache %s: %s', cache_path, err)
+        return None
 
 
 def get_tumor_markup(user_name):
     """
     Find what the pathologist circled as tumor.
+    Markups are cached locally per (case_id, execution_id). The cache is
+    used as long as the database still holds the same number of markups
+    with the same latest _id, or whenever the database can't be reached.
     :param user_name:
     :return:
     """
     tumor_markup_list = []
     execution_id = (user_name + "_Tumor_Region")
-    try:
-        client = mongodb_connect('mongodb://' + DB_HOST + ':27017')
-        client.server_info()  # force connection, trigger error to be caught
-        db = client.quip
-        coll = db.objects
-        filter_q = {
-            'provenance.image.case_id': CASE_ID,
-            'provenance.analysis.execution_id': execution_id
-        }
-        projection_q = {
-            'geometry.coordinates': 1,
-            '_id': 0
-        }
-        print('quip.objects')
-        print(filter_q, ',', projection_q)
-        cursor = coll.find(filter_q, projection_q)
-        for item in cursor:
-            # geometry.coordinates happens to be a list with one thing in it: a list! (of point coordinates).
-            temp = item['geometry']['coordinates']  # [ [ [ x, y ], ... ] ]
-            points = temp[0]  # [ [x, y ], ... ]
-            tumor_markup_list.append(points)
-        client.close()
-    except errors.ServerSelectionTimeoutError as err:
-        print('Error in get_tumor_markup', err)
-        exit(1)
+    cached = read_markup_cache(execution_id)
+
+    if OFFLINE_MARKUPS:
+        if cached is None:
+            LOG.error('No cached tumor markups for %s %s', CASE_ID, execution_id)
+            exit(1)
+        LOG.info('Using cached tumor markups (offline)')
+        tumor_markup_list = cached['markups']
+    else:
+        try:
+            # Shared connection, see connect_db
+            db = CLIENT.quip
+            coll = db.objects
+            filter_q = {
+                'provenance.image.case_id': CASE_ID,
+                'provenance.analysis.execution_id': execution_id
+            }
+            projection_q = {
+                'geometry.coordinates': 1,
+                '_id': 0
+            }
+
+            # Staleness check: same count and same latest document as when cached
+            count = coll.count_documents(filter_q)
+            latest = [str(item['_id']) for item in coll.find(filter_q, {'_id': 1}).sort('_id', -1).limit(1)]
+            latest = latest[0] if latest else None
+
+            if cached is not None and cached['count'] == count and cached['latest'] == latest:
+                LOG.info('Using cached tumor markups')
+                tumor_markup_list = cached['markups']
+            else:
+                LOG.debug('quip.objects %s, %s', filter_q, projection_q)
+                cursor = coll.find(filter_q, projection_q)
+                for item in cursor:
+                    # geometry.coordinates happens to be a list with one thing in it: a list! (of point coordinates).
+                    temp = item['geometry']['coordinates']  # [ [ [ x, y ], ... ] ]
+                    points = temp[0]  # [ [x, y ], ... ]
+                    tumor_markup_list.append(points)
+
+                cache_path = get_markup_cache_path(execution_id)
+                assure_path_exists(cache_path)
+                with open(cache_path, 'w') as f:
+                    json.dump({'count': count, 'latest': latest, 'markups': tumor_markup_list}, f)
+                f.close()
+        except errors.PyMongoError as err:
+            if cached is None:
+                LOG.error('Error in get_tumor_markup: %s', err)
+                exit(1)
+            LOG.warning('Error in get_tumor_markup, using cached tumor markups: %s', err)
+            tumor_markup_list = cached['markups']
 
     count = len(tumor_markup_list)
     if count == 0:
-        print('No tumor markups were generated by ', user_name)
+        LOG.error('No tumor markups were generated by %s', user_name)
         exit(1)
 
-    print('Tumor markup count: ', count)
+    LOG.info('Tumor markup count: %s', count)
     return tumor_markup_list
 
 
@@ -142,19 +463,12 @@ def markup_to_polygons(markup_list):
     try:
         # roll through our list of lists
         for coordinates in markup_list:
-            points_list = []
-            # convert the point coordinates to Points
-            for m_point in coordinates:
-                m_point = Point(m_point[0], m_point[1])
-                # print('m_point', m_point)  # normalized
-                points_list.append(m_point)
-            # create a Polygon
-            m = MultiPoint(points_list)
-            m_polygon = Polygon(m)
+            # create a Polygon straight from the point coordinates
+            m_polygon = Polygon(np.asarray(coordinates, dtype=np.float64)[:, :2])
             # append to return-list
             m_poly_list.append(m_polygon)
     except Exception as ex:
-        print('Error in convert_to_polygons', ex)
+        LOG.error('Error in convert_to_polygons: %s', ex)
         exit(1)
 
     # Return list of polygons
@@ -194,15 +508,76 @@ def string_to_polygon(poly_data, imw, imh, normalize):
         m = MultiPoint(points_list)
         m_polygon = Polygon(m)
     except Exception as ex:
-        print('Error in string_to_polygon', ex)
+        LOG.error('Error in string_to_polygon: %s', ex)
         exit(1)
 
     return m_polygon
 
 
+def polygon_column_to_coords(poly_col, imw=1, imh=1, normalize=False):
+    """
+    Bulk version of string_to_polygon for a whole Polygon column.
+    Returns flat (n_points, 2) coordinates and per-nucleus offsets, so
+    nucleus i is coords[offsets[i]:offsets[i + 1]].
+    :param poly_col:
+    :param imw:
+    :param imh:
+    :param normalize:
+    :return:
+    """
+    strings = [str(v).translate(POLYGON_BRACKETS).strip() for v in poly_col]
+    # Drop empty values, e.g. from a trailing separator in [1:2:3:4:5:6:]
+    strings = [':'.join(v for v in s.split(':') if v.strip()) if (s.startswith(':') or s.endswith(':') or '::' in s)
+               else s for s in strings]
+    counts = np.array([(s.count(':') + 1) if s else 0 for s in strings], dtype=np.int64)
+
+    # Parse every value in one call; fall back to one string at a time if it didn't line up
+    try:
+        values = np.fromstring(':'.join(s for s in strings if s), dtype=np.float64, sep=':')
+    except ValueError:
+        values = None
+    if values is None or len(values) != counts.sum():
+        try:
+            values = np.array([float(v) for s in strings if s for v in s.split(':')], dtype=np.float64)
+        except Exception as ex:
+            LOG.error('Error in polygon_column_to_coords: %s', ex)
+            exit(1)
+
+    # Like string_to_polygon, drop a trailing unpaired value
+    odd = counts % 2 == 1
+    if odd.any():
+        keep = np.ones(len(values), dtype=bool)
+        keep[np.cumsum(counts)[odd] - 1] = False
+        values = values[keep]
+
+    coords = values.reshape(-1, 2)
+    if normalize:
+        coords = coords / np.array([float(imw), float(imh)])
+
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts // 2, out=offsets[1:])
+    return coords, offsets
+
+
+def coords_to_polygon(coords, offsets, i):
+    """
+    Build the Polygon for nucleus i out of polygon_column_to_coords output.
+    :param coords:
+    :param offsets:
+    :param i:
+    :return:
+    """
+    try:
+        return Polygon(coords[offsets[i]:offsets[i + 1]])
+    except Exception as ex:
+        LOG.error('Error in coords_to_polygon: %s', ex)
+        exit(1)
+
+
 def get_data_files():
     """
-    Return 2 lists containing full paths for CSVs and JSONs.
+    Return the list of JSON paths, and the CSV paths indexed by tile:
+    {(tile_minx, tile_miny): [paths]}, parsed from the x<minx>_y<miny> part of the file names.
     :return:
     """
     filenames = os.listdir(SLIDE_DIR)  # get all files' and folders' names in directory
@@ -233,141 +608,269 @@ def get_data_files():
 
     json_files.sort()
     csv_files.sort()
-    return json_files, csv_files
 
+    csv_index = {}
+    unmatched = 0
+    for ppath in csv_files:
+        match = TILE_KEY_RE.search(os.path.basename(ppath))
+        if match:
+            csv_index.setdefault((int(match.group(1)), int(match.group(2))), []).append(ppath)
+        else:
+            unmatched += 1
+    if unmatched:
+        LOG.warning('CSV files without a tile position in their name: %s', unmatched)
 
-def get_poly_within(jfiles, tumor_list):
+    return json_files, csv_index
+
+
+def read_tile_json(jfile):
+    """
+    Tile geometry and out_file_prefix from one per-tile JSON file.
+    :param jfile:
+    :return:
+    """
+    with open(jfile, 'r') as f:
+        json_dict = json.load(f)
+    f.close()
+    return (json_dict['tile_minx'], json_dict['tile_miny'], json_dict['tile_width'], json_dict['tile_height'],
+            json_dict['image_width'], json_dict['image_height'], json_dict['out_file_prefix'])
+
+
+def build_tile_manifest(jfiles):
     """
-    Identify only the files within the tumor regions
+    Read every per-tile JSON (on MANIFEST_THREADS threads) into a structured
+    array with one row per tile; later duplicates of a tile position are dropped.
     :param jfiles:
-    :param tumor_list:
+    :return: (tiles, number of duplicates dropped)
+    """
+    pool = ThreadPoolExecutor(max_workers=max(MANIFEST_THREADS, 1))
+    try:
+        records = list(pool.map(read_tile_json, jfiles))
+    finally:
+        pool.shutdown()
+
+    tiles = []
+    seen = set()
+    for record in records:
+        if (record[0], record[1]) not in seen:  # If the object is not in the list yet...
+            seen.add((record[0], record[1]))
+            tiles.append(record)
+
+    prefix_len = max([len(record[6]) for record in tiles] + [1])
+    tiles = np.array(tiles, dtype=TILE_MANIFEST_FIELDS + [('out_file_prefix', 'U{}'.format(prefix_len))])
+    return tiles, len(records) - len(tiles)
+
+
+def log_duplicate_tiles(dupes):
+    """
+    Report per-tile JSON files that repeat a tile position.
+    :param dupes:
     :return:
     """
-    # print('files len: ', len(jfiles))
-    # print('tumor_list len: ', len(tumor_list))
-    temp = {}
-    path_poly = {}
-    # rtn_jfiles = []
-    rtn_obj = {}
-    # start_time = time.time()
+    if dupes:
+        LOG.warning('Duplicate tiles dropped: %s', dupes)
+    else:
+        LOG.debug('dupes %s', dupes)
+
 
-    # Collect data
-    z = set()
-    count = 0
+def load_tile_manifest(jfiles):
+    """
+    build_tile_manifest, kept in SLIDE_DIR/tile_manifest.npz until any JSON
+    file is added, removed or changed.
+    :param jfiles:
+    :return:
+    """
+    stamp = hashlib.sha1()
     for jfile in jfiles:
-        with open(jfile, 'r') as f:
-            # Read JSON data into the json_dict variable
-            json_dict = json.load(f)
-            # str = json_dict['out_file_prefix']
-            imw = json_dict['image_width']
-            imh = json_dict['image_height']
-            tile_height = json_dict['tile_height']
-            tile_width = json_dict['tile_width']
-            tile_minx = json_dict['tile_minx']
-            tile_miny = json_dict['tile_miny']
-            fp = json_dict['out_file_prefix']
-
-            item = 'x' + str(tile_minx) + '_' + 'y' + str(tile_miny)
-            if item not in z:  # If the object is not in the list yet...
-                inc_x = tile_minx + tile_width
-                inc_y = tile_miny + tile_height
-                # Create polygon for comparison
-                point1 = Point(float(tile_minx) / float(imw), float(tile_miny) / float(imh))
-                # print('point1', point1)  # normalized
-                point2 = Point(float(inc_x) / float(imw), float(tile_miny) / float(imh))
-                point3 = Point(float(inc_x) / float(imw), float(inc_y) / float(imh))
-                point4 = Point(float(tile_minx) / float(imw), float(inc_y) / float(imh))
-                point5 = Point(float(tile_minx) / float(imw), float(tile_miny) / float(imh))
-                m = MultiPoint([point1, point2, point3, point4, point5])
-                polygon = Polygon(m)
-                # Map data file location (prefix) to bbox polygon
-                # path_poly[f.name[:-pos]] = polygon
-                path_poly[item] = {'poly': polygon, 'image_width': imw, 'image_height': imh, 'tile_width': tile_width,
-                                   'tile_height': tile_height, 'tile_minx': tile_minx, 'tile_miny': tile_miny,
-                                   'out_file_prefix': fp}
-            else:
-                count += 1
+        st = os.stat(jfile)
+        stamp.update('{}:{}:{}\n'.format(jfile, st.st_size, st.st_mtime_ns).encode('utf-8'))
+    stamp = stamp.hexdigest()
+
+    manifest_path = os.path.join(SLIDE_DIR, 'tile_manifest.npz')
+    if os.path.isfile(manifest_path):
+        try:
+            with np.load(manifest_path, allow_pickle=False) as cached:
+                if str(cached['stamp']) == stamp:
+                    log_duplicate_tiles(int(cached['dupes']))
+                    return cached['tiles']
+        except Exception as err:
+            LOG.warning('Ignoring unreadable tile manifest %s: %s', manifest_path, err)
+
+    tiles, dupes = build_tile_manifest(jfiles)
+    log_duplicate_tiles(dupes)
+    with open(manifest_path, 'wb') as f:
+        np.savez(f, stamp=np.array(stamp), tiles=tiles, dupes=np.array(dupes))
+    f.close()
+    return tiles
 
-            z.add(item)
 
-        f.close()
-        temp.update(path_poly)
+def get_poly_within(manifest, tumor_list):
+    """
+    Identify only the tiles within the tumor regions
+    :param manifest: see build_tile_manifest
+    :param tumor_list:
+    :return:
+    """
+    LOG.debug('len %s', len(manifest))
+    rtn_obj = {}
 
-    print('dupes', count)
-    print('len', len(temp))
+    # Normalized tile bboxes, to pick candidate tiles for each tumor region
+    imw = manifest['image_width'].astype(np.float64)
+    imh = manifest['image_height'].astype(np.float64)
+    bounds = np.column_stack([manifest['tile_minx'] / imw, manifest['tile_miny'] / imh,
+                              (manifest['tile_minx'] + manifest['tile_width']) / imw,
+                              (manifest['tile_miny'] + manifest['tile_height']) / imh])
 
     for tumor_roi in tumor_list:
-        for key, val in temp.items():
-            gotone = False
-            p = val['poly']
-            if p.within(tumor_roi):
-                gotone = True
-            elif p.intersects(tumor_roi):
-                gotone = True
-            elif tumor_roi.within(p):
-                gotone = True
-            elif tumor_roi.intersects(p):
-                gotone = True
-            if gotone:
-                # print('val', val)
-                rtn_obj.update({key: val})
-
-    # elapsed_time = time.time() - start_time
-    # print('Runtime get_poly_within: ')
-    # print(time.strftime("%H:%M:%S", time.gmtime(elapsed_time)))
-
-    # return rtn_jfiles
+        if tumor_roi.is_empty:
+            continue
+        minx, miny, maxx, maxy = tumor_roi.bounds
+        candidates = np.flatnonzero((bounds[:, 0] <= maxx) & (bounds[:, 2] >= minx) &
+                                    (bounds[:, 1] <= maxy) & (bounds[:, 3] >= miny))
+        # within either way implies intersects, which is symmetric: one test is enough
+        prepared_roi = prep(tumor_roi)
+        for i in candidates:
+            if prepared_roi.intersects(box(*bounds[i])):
+                tile = manifest[i]
+                key = 'x' + str(tile['tile_minx']) + '_' + 'y' + str(tile['tile_miny'])
+                if key not in rtn_obj:
+                    rtn_obj[key] = {name: int(tile[name]) for name, _ in TILE_MANIFEST_FIELDS}
+                    rtn_obj[key]['out_file_prefix'] = str(tile['out_file_prefix'])
+
     return rtn_obj
 
 
-def aggregate_data(jfile_objs, CSV_FILES):
+def get_feature_dtypes():
+    """
+    Column dtypes of the *features.csv files, from config/dtypes.list
+    (lines like "Perimeter: <type 'numpy.float64'>"), for FEATURE_COLUMNS.
+    Float columns become float32 with FLOAT32.
+    :return:
+    """
+    if not FEATURE_DTYPES:
+        with open('config/dtypes.list') as f:
+            for line in f:
+                name, _, type_str = line.strip().rpartition(': ')
+                if name not in FEATURE_COLUMNS:
+                    continue
+                type_name = type_str.replace("<type '", '').replace("'>", '').replace('numpy.', '')
+                if type_name == 'str':
+                    FEATURE_DTYPES[name] = object
+                elif type_name.startswith('float') and FLOAT32:
+                    FEATURE_DTYPES[name] = np.float32
+                else:
+                    FEATURE_DTYPES[name] = np.dtype(type_name)
+        f.close()
+    return FEATURE_DTYPES
+
+
+def read_features_csv(path):
+    """
+    Read only FEATURE_COLUMNS of a *features.csv file, with explicit dtypes.
+    :param path:
+    :return: DataFrame, or None if the file is empty
+    """
+    if os.path.getsize(path) == 0:
+        return None
+    return pandas.read_csv(path, usecols=FEATURE_COLUMNS, dtype=get_feature_dtypes())
+
+
+def get_cache_path(path):
+    """
+    Cache file for a *features.csv file, named after its absolute path.
+    :param path:
+    :return:
+    """
+    key = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_DIR, key + '.npz')
+
+
+def load_features(path):
+    """
+    Feature columns and parsed polygon coordinates of a *features.csv file.
+    Results are kept in a .npz file under CACHE_DIR, keyed by source path,
+    size and mtime; a cache entry that doesn't match the file is rebuilt.
+    :param path:
+    :return: (df without the Polygon column, coords, offsets), or None if the file is empty
+    """
+    st = os.stat(path)
+    if st.st_size == 0:
+        return None
+    stamp = [os.path.abspath(path), str(st.st_size), str(st.st_mtime_ns), str(FLOAT32)]
+    columns = [column for column in FEATURE_COLUMNS if column != 'Polygon']
+
+    cache_path = get_cache_path(path) if CACHE_DIR else None
+    if cache_path and os.path.isfile(cache_path):
+        try:
+            with METRICS.timer('feature_cache'), np.load(cache_path, allow_pickle=False) as cached:
+                if list(cached['stamp']) == stamp:
+                    df = pandas.DataFrame({column: cached[column] for column in columns}, columns=columns)
+                    return df, cached['coords'], cached['offsets']
+        except Exception as err:
+            LOG.warning('Ignoring unreadable cache entry %s: %s', cache_path, err)
+
+    with METRICS.timer('csv_load'):
+        df = read_features_csv(path)
+    with METRICS.timer('polygon_parse'):
+        coords, offsets = polygon_column_to_coords(df['Polygon'].values)
+    df = df[columns]
+
+    if cache_path:
+        METRICS.count('feature_cache_writes')
+        assure_path_exists(cache_path)
+        tmp_path = cache_path + '.{}.tmp'.format(os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, stamp=np.array(stamp), coords=coords, offsets=offsets,
+                     **{column: df[column].values for column in columns})
+        f.close()
+        os.replace(tmp_path, cache_path)
+
+    return df, coords, offsets
+
+
+def aggregate_data(jfile_objs, csv_index):
     """
     Get data
     :param jfile_objs:
-    :param CSV_FILES
+    :param csv_index: see get_data_files
     :return:
     """
-    start_time = time.time()
     obj_map = {}
     obj_map1 = {}
     rtn_dict = {}
 
     for k, v in jfile_objs.items():
-        filelist = []
-        for ff in CSV_FILES:
-            if k in ff:
-                filelist.append(ff)
+        filelist = csv_index.get((int(v['tile_minx']), int(v['tile_miny'])), [])
 
         data_obj = {'filelist': filelist, "image_width": v['image_width'], "image_height": v['image_height'],
                     "tile_height": v['tile_height'], "tile_width": v['tile_width'], "tile_minx": v['tile_minx'],
                     "tile_miny": v['tile_miny']}
         obj_map.update({k: data_obj})
 
-    print('obj_map', len(obj_map))
-    print('Aggregating csv data...')
+    LOG.debug('obj_map %s', len(obj_map))
+    LOG.info('Aggregating csv data...')
 
     for k, v in obj_map.items():
         frames = []
+        coord_list = []
+        offset_list = []
+        num_points = 0
         for ff in v['filelist']:
-            df = pandas.read_csv(ff)
-            # print('df.shape[0]: ', df.shape[0])
-            if df.empty:
-                # print('empty!')
-                # print(len(v['filelist']))
-                # print(k)
-                # print(ff)
+            features = load_features(ff)
+            if features is None or features[0].empty:
                 continue
             else:
-                # new = old[['A', 'C', 'D']].copy()
-                df1 = df[
-                    ['Perimeter', 'Flatness', 'Circularity', 'r_GradientMean', 'b_GradientMean',
-                     'b_cytoIntensityMean', 'r_cytoIntensityMean', 'r_IntensityMean', 'r_cytoGradientMean',
-                     'Elongation', 'Polygon']].copy()
-                frames.append(df1)
+                df, coords, offsets = features
+                frames.append(df)
+                coord_list.append(coords)
+                offset_list.append(offsets[:-1] + num_points)
+                num_points += len(coords)
 
         if frames:
             result = pandas.concat(frames)
-            data_obj1 = {'df': result, "image_width": v['image_width'], "image_height": v['image_height'],
+            offset_list.append(np.array([num_points], dtype=np.int64))
+            data_obj1 = {'df': result, 'coords': np.concatenate(coord_list), 'offsets': np.concatenate(offset_list),
+                         "image_width": v['image_width'], "image_height": v['image_height'],
                          "tile_height": v['tile_height'], "tile_width": v['tile_width'], "tile_minx": v['tile_minx'],
                          "tile_miny": v['tile_miny']}
 
@@ -376,10 +879,6 @@ def aggregate_data(jfile_objs, CSV_FILES):
         # Add to return variable
         rtn_dict.update(obj_map1)
 
-    elapsed_time = time.time() - start_time
-    print('Runtime aggregate_data: ')
-    print(time.strftime("%H:%M:%S", time.gmtime(elapsed_time)))
-
     return rtn_dict
 
 
@@ -393,7 +892,8 @@ def get_mongo_doc(slide, patch_data):
     # TODO:!
 
     # Ratio of nuclear material
-    percent_nuclear_material = float((patch_data['nucleus_area'] / (PATCH_SIZE * PATCH_SIZE)) * 100)
+    patch_size = patch_data['patch_size']
+    percent_nuclear_material = float((patch_data['nucleus_area'] / (patch_size * patch_size)) * 100)
     # print("Ratio of nuclear material: ", percent_nuclear_material)
 
     patch_index = patch_data['patch_num']
@@ -409,8 +909,11 @@ def get_mongo_doc(slide, patch_data):
         "patch_index": patch_index,
         "patch_min_x_pixel": patch_data['patch_minx'],
         "patch_min_y_pixel": patch_data['patch_miny'],
-        "patch_size": PATCH_SIZE,
-        "patch_polygon_area": patch_polygon_area,
+        "patch_size": patch_size,
+        "patch_polygon_area": patch_polygon_area[patch_size],
+        # Pyramid level the intensity statistics were read from; part of PATCH_KEY
+        "stats_level": patch_data['stats_level'],
+        "stats_downsample": float(slide.level_downsamples[patch_data['stats_level']]),
         "nucleus_area": patch_data['nucleus_area'],
         "percent_nuclear_material": percent_nuclear_material,
         # "patch_area_selected_percentage": 100.0,
@@ -446,91 +949,440 @@ def get_mongo_doc(slide, patch_data):
     return mydoc
 
 
-def update_db(slide, patch_data, db_name):
+class PatchWriter(object):
     """
-    Write data, per patch.
-    :param slide:
-    :param patch_data:
+    Collect patch documents and write them to a collection in batches of
+    unordered upserts keyed on PATCH_KEY, so rerunning a tile replaces its
+    documents instead of duplicating them. Only bulk_write is used, so any
+    collection-like object (a local mongod or an in-process stand-in) will do.
+    Tiles whose documents were all written are appended to a checkpoint file.
+    """
+
+    def __init__(self, collection, batch_size=1000, flush_interval=30.0, checkpoint=None):
+        """
+        :param collection:
+        :param batch_size: flush when this many documents are queued
+        :param flush_interval: flush when this many seconds passed since the last flush
+        :param checkpoint: file finished tiles are recorded in, see read_checkpoint
+        """
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.checkpoint = checkpoint
+        self.docs = []
+        self.tiles = []
+        self.last_flush = time.time()
+        self.batches = 0
+        self.written = 0
+        self.failed = 0
+
+    def add(self, doc):
+        """
+        Queue a document, flushing if the batch is full or due.
+        :param doc:
+        :return:
+        """
+        self.docs.append(doc)
+        if len(self.docs) >= self.batch_size or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def add_tile(self, tile, docs):
+        """
+        Queue all documents of a tile; the tile is checkpointed once they are written.
+        :param tile: (tile_minx, tile_miny)
+        :param docs:
+        :return:
+        """
+        failed = self.failed
+        for doc in docs:
+            self.add(doc)
+        self.tiles.append((tile, failed))
+
+    def flush(self):
+        """
+        Write queued documents; report, but don't stop on, per-batch errors.
+        :return:
+        """
+        self.last_flush = time.time()
+        if self.docs:
+            self.write()
+        self.write_checkpoint()
+
+    def write(self):
+        """
+        Upsert the queued documents in one unordered bulk write.
+        :return:
+        """
+        docs = self.docs
+        self.docs = []
+        self.batches += 1
+        requests = [UpdateOne(dict((key, doc[key]) for key in PATCH_KEY), {'$set': doc}, upsert=True)
+                    for doc in docs]
+        try:
+            with METRICS.timer('db_write'):
+                result = self.collection.bulk_write(requests, ordered=False)
+            self.written += result.upserted_count + result.matched_count
+            METRICS.count('docs_written', result.upserted_count + result.matched_count)
+        except errors.BulkWriteError as err:
+            write_errors = err.details.get('writeErrors', [])
+            written = err.details.get('nUpserted', 0) + err.details.get('nMatched', 0)
+            self.written += written
+            METRICS.count('docs_written', written)
+            self.failed += len(docs) - written
+            LOG.error('Batch %s write errors: %s', self.batches, len(write_errors))
+            for write_error in write_errors[:10]:
+                LOG.error('  doc %s: %s', write_error.get('index'), write_error.get('errmsg'))
+        except errors.PyMongoError as err:
+            self.failed += len(docs)
+            LOG.error('Batch %s failed (%s docs): %s', self.batches, len(docs), err)
+
+    def write_checkpoint(self):
+        """
+        Record the queued tiles with no failed writes since they were added;
+        the others are left to be redone.
+        :return:
+        """
+        tiles = [tile for tile, failed in self.tiles if failed == self.failed]
+        self.tiles = []
+        if self.checkpoint and tiles:
+            with open(self.checkpoint, 'a') as f:
+                for tile_minx, tile_miny in tiles:
+                    f.write('{},{}\n'.format(tile_minx, tile_miny))
+
+    def close(self):
+        """
+        Flush whatever is left and print a summary.
+        :return:
+        """
+        self.flush()
+        LOG.info('%s: %s docs written in %s batches, %s failed', self.collection.name, self.written, self.batches,
+                 self.failed)
+
+
+def get_writer(db_name, checkpoint=None):
+    """
+    Return the PatchWriter for a collection, creating it (and the index
+    its upserts look documents up by) on first use. Open writers are flushed
+    on exit, see flush_writers.
     :param db_name:
+    :param checkpoint: see PatchWriter
     :return:
     """
+    if db_name not in WRITERS:
+        try:
+            DB[db_name].create_index([(key, ASCENDING) for key in PATCH_KEY])
+        except errors.PyMongoError as err:
+            LOG.warning('Error creating index on %s: %s', db_name, err)
+        WRITERS[db_name] = PatchWriter(DB[db_name], DB_BATCH_SIZE, DB_FLUSH_INTERVAL, checkpoint)
+    return WRITERS[db_name]
 
-    df = patch_data['df']
+
+@atexit.register
+def flush_writers():
+    """
+    Flush the open PatchWriters, so an early exit doesn't lose queued documents.
+    :return:
+    """
+    for writer in WRITERS.values():
+        writer.flush()
+
+
+def get_checkpoint_path():
+    """
+    Checkpoint file of the current slide, collection, patch sizes and,
+    for reduced-level statistics, --stats_level/--stats_mpp.
+    :return:
+    """
+    sizes = '-'.join(str(size) for size in sorted(set(PATCH_SIZES)))
+    if STATS_MPP:
+        sizes += '_mpp{:g}'.format(STATS_MPP)
+    elif STATS_LEVEL:
+        sizes += '_level{}'.format(STATS_LEVEL)
+    return os.path.join(SLIDE_DIR, 'checkpoint_{}_{}.txt'.format(coll_name, sizes))
+
+
+def read_checkpoint(path):
+    """
+    Tiles recorded as finished in a checkpoint file.
+    :param path:
+    :return: set of (tile_minx, tile_miny)
+    """
+    done = set()
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                fields = line.strip().split(',')
+                # A line cut short by a crash is ignored
+                if len(fields) == 2 and all(fields):
+                    done.add((int(fields[0]), int(fields[1])))
+    return done
+
+
+def close_writers():
+    """
+    Flush and close all PatchWriters.
+    :return: number of documents that failed to write
+    """
+    failed = 0
+    for writer in WRITERS.values():
+        writer.close()
+        failed += writer.failed
+    WRITERS.clear()
+    return failed
+
+
+def build_patch_doc(slide, patch_data):
+    """
+    Compute the document for one patch.
+    :param slide:
+    :param patch_data:
+    :return:
+    """
 
     mydoc = get_mongo_doc(slide, patch_data)
 
-    # read_region returns an RGBA Image (PIL)
-    patch = slide.read_region((patch_data['patch_minx'], patch_data['patch_miny']), 0, (PATCH_SIZE, PATCH_SIZE))
+    # Histology, computed by do_tiles for all patches of the tile
+    mydoc.update(patch_data['histology'])
 
-    # Histology
-    mydoc = patch_operations(patch, mydoc)
+    # Segment statistics are only present when the patch has nuclei
+    mydoc.update(patch_data['segment_stats'])
 
-    mycol = DB[db_name]  # name
-    # Connect to MongoDB
-    # try:
-    #     client = mongodb_connect('mongodb://' + DB_HOST + ':27017')
-    #     client.server_info()  # force connection, trigger error to be caught
-    #     db = client.quip_comp
-    #     mycol = db[db_name + '_features_td']  # name
-    # except Exception as e:
-    #     print('Connection error: ', e)
-    #     exit(1)
+    if 'tumor_overlap' in patch_data:
+        mydoc['tumor_overlap'] = patch_data['tumor_overlap']
+
+    if 'nucleus_area_raster' in patch_data:
+        mydoc['nucleus_area_raster'] = patch_data['nucleus_area_raster']
 
+    if 'tissue_fraction' in patch_data:
+        # Nuclear material relative to the tissue, leaving out bright (glass) areas
+        tissue_fraction = patch_data['tissue_fraction']
+        mydoc['tissue_fraction'] = tissue_fraction
+        mydoc['percent_nuclear_material_tissue'] = \
+            mydoc['percent_nuclear_material'] / tissue_fraction if tissue_fraction > 0 else "n/a"
+        if 'blank' in patch_data:
+            mydoc['blank'] = patch_data['blank']
+
+    return mydoc
+
+
+def init_worker(slide_path):
+    """
+    Pool initializer: each worker process opens its own slide handle.
+    :param slide_path:
+    :return:
+    """
+    global WORKER_SLIDE
+    WORKER_SLIDE = openslide.OpenSlide(slide_path)
+
+
+def run_tile(key, slide=None):
+    """
+    Compute the patch documents of one tile, catching any failure
+    (including exit() calls further down) so one bad tile can't end the run.
+    :param key: key into TILE_DATA
+    :param slide: slide handle; the worker's own handle if None
+    :return: (key, docs, error, Metrics of the tile)
+    """
+    global METRICS
+    in_worker = slide is None
+    if in_worker:
+        slide = WORKER_SLIDE
+    # Fresh metrics per tile, merged by calculate (a forked worker's copy holds the parent's)
+    slide_metrics = METRICS
+    METRICS = Metrics()
     try:
-        if not df.empty:
-            mydoc['flatness_segment_mean'] = df['Flatness'].mean()
-            mydoc['flatness_segment_std'] = df['Flatness'].std()
-            mydoc['perimeter_segment_mean'] = df['Perimeter'].mean()
-            mydoc['perimeter_segment_std'] = df['Perimeter'].std()
-            mydoc['circularity_segment_mean'] = df['Circularity'].mean()
-            mydoc['circularity_segment_std'] = df['Circularity'].std()
-            mydoc['r_GradientMean_segment_mean'] = df['r_GradientMean'].mean()
-            mydoc['r_GradientMean_segment_std'] = df['r_GradientMean'].std()
-            mydoc['b_GradientMean_segment_mean'] = df['b_GradientMean'].mean()
-            mydoc['b_GradientMean_segment_std'] = df['b_GradientMean'].std()
-            mydoc['r_cytoIntensityMean_segment_mean'] = df['r_cytoIntensityMean'].mean()
-            mydoc['r_cytoIntensityMean_segment_std'] = df['r_cytoIntensityMean'].std()
-            mydoc['b_cytoIntensityMean_segment_mean'] = df['b_cytoIntensityMean'].mean()
-            mydoc['b_cytoIntensityMean_segment_std'] = df['b_cytoIntensityMean'].std()
-            mydoc['elongation_segment_mean'] = df['Elongation'].mean()
-            mydoc['elongation_segment_std'] = df['Elongation'].std()
-
-        # Insert record in either case
-        mycol.insert_one(mydoc)
-
-    except Exception as err:
-        print('update_db error: ', err)
-        exit(1)
-    # print('mydoc', json.dumps(mydoc, indent=4, sort_keys=True))
+        with METRICS.timer('geometry'):
+            docs = do_tiles(TILE_DATA[key], slide)
+        return key, docs, None, METRICS
+    except (Exception, SystemExit) as err:
+        return key, None, '{}: {}'.format(type(err).__name__, err), METRICS
+    finally:
+        if in_worker:
+            # Workers are started per slide, so their peak covers this slide
+            METRICS.peak('rss_workers_mb', get_peak_rss_mb())
+        METRICS = slide_metrics
+
+
+def get_area_rows(docs):
+    """
+    (size, x, y, vector area, raster area) of each patch, for write_area_report.
+    :param docs:
+    :return:
+    """
+    if AREA_MODE != 'compare':
+        return []
+    return [(mydoc['patch_size'], mydoc['patch_min_x_pixel'], mydoc['patch_min_y_pixel'], mydoc['nucleus_area'],
+             mydoc['nucleus_area_raster']) for mydoc in docs]
+
+
+def write_area_report(area_rows):
+    """
+    Compare raster against vector nucleus_area: per-patch CSV in SLIDE_DIR
+    plus a summary, for each patch size.
+    :param area_rows:
+    :return:
+    """
+    for patch_size in PATCH_SIZES:
+        write_size_area_report(patch_size, [row[1:] for row in area_rows if row[0] == patch_size])
+
+
+def write_size_area_report(patch_size, area_rows):
+    """
+    write_area_report for one patch size.
+    :param patch_size:
+    :param area_rows:
+    :return:
+    """
+    report_path = os.path.join(SLIDE_DIR, 'nucleus_area_report_{}.csv'.format(patch_size))
+    with open(report_path, 'w') as f:
+        f.write('patch_min_x_pixel,patch_min_y_pixel,nucleus_area_vector,nucleus_area_raster\n')
+        for row in area_rows:
+            f.write('{},{},{},{}\n'.format(*row))
+
+    if area_rows:
+        vector = np.array([row[2] for row in area_rows])
+        raster = np.array([row[3] for row in area_rows])
+        diff = np.abs(raster - vector)
+        LOG.info('%s px nucleus_area raster vs vector over %s patches: mean abs diff %.4f, max abs diff %.4f, '
+                 'total %.4f vs %.4f (%+.2f%%)', patch_size, len(area_rows), diff.mean(), diff.max(), raster.sum(),
+                 vector.sum(), 100.0 * (raster.sum() - vector.sum()) / max(vector.sum(), 1e-12))
+    LOG.info('nucleus_area report: %s', report_path)
+
+
+def get_tile_position(data):
+    """
+    (tile_minx, tile_miny) of a tile, as recorded in checkpoint files.
+    :param data:
+    :return:
+    """
+    return int(data['tile_minx']), int(data['tile_miny'])
 
 
 def calculate(tile_data):
     """
     Mean and std of Perimeter, Flatness, Circularity,
     r_GradientMean, b_GradientMean, b_cytoIntensityMean, r_cytoIntensityMean.
+    With WORKERS > 1 tiles are spread over a process pool, and patch
+    documents stream back here to be written.
     :param tile_data:
-    :return:
+    :return: list of (key, error) for the tiles that failed
     """
+    global TILE_DATA
+    # Workers inherit the tile data through fork rather than pickling it
+    TILE_DATA = tile_data
+    failures = []
+    area_rows = []
+    # Tiles whose reduced-level statistics are checked against level 0
+    check_docs = []
+    check_keys = set(list(tile_data.keys())[:STATS_CHECK]) if (STATS_LEVEL or STATS_MPP) else set()
+
     p = Path(os.path.join(SLIDE_DIR, (CASE_ID + '.svs')))
-    print('Reading slide...')
-    start_time = time.time()
-    slide = openslide.OpenSlide(str(p))
+    writer = get_writer(coll_name, get_checkpoint_path())
+
+    def collect(key, docs, err, tile_metrics):
+        METRICS.merge(tile_metrics)
+        if err is not None:
+            LOG.error('Tile %s failed: %s', key, err)
+            METRICS.count('tiles_failed')
+            failures.append((key, err))
+            return
+        METRICS.count('tiles')
+        METRICS.count('patches', len(docs))
+        writer.add_tile(get_tile_position(tile_data[key]), docs)
+        area_rows.extend(get_area_rows(docs))
+        if key in check_keys:
+            check_docs.extend(docs)
+
+    if WORKERS > 1:
+        LOG.info('Processing %s tiles with %s workers...', len(tile_data), WORKERS)
+        # Unlike multiprocessing.Pool, the executor fails the pending tiles if a worker dies
+        pool = ProcessPoolExecutor(WORKERS, mp_context=multiprocessing.get_context('fork'),
+                                   initializer=init_worker, initargs=(str(p),))
+        try:
+            futures = dict((pool.submit(run_tile, key), key) for key in tile_data.keys())
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except BrokenProcessPool as err:
+                    # e.g. a crash in OpenSlide or the OOM killer; the tile isn't checkpointed
+                    result = (futures[future], None, 'BrokenProcessPool: {}'.format(err), Metrics())
+                collect(*result)
+        finally:
+            pool.shutdown()
+    else:
+        LOG.info('Processing %s tiles...', len(tile_data))
+        slide = openslide.OpenSlide(str(p))
+
+        # Iterate through tile data
+        for key in tile_data.keys():
+            # Create patches
+            collect(*run_tile(key, slide))
+
+        slide.close()
+
+    if failures:
+        LOG.warning('%s of %s tiles failed', len(failures), len(tile_data))
+
+    if AREA_MODE == 'compare':
+        write_area_report(area_rows)
+
+    if check_docs:
+        slide = openslide.OpenSlide(str(p))
+        level = get_stats_level(slide)
+        if level:
+            report_stats_level(slide, check_docs, level)
+        slide.close()
+
+    return failures
+
+
+def get_hed_lut(dtype):
+    """
+    Optical density lookup table od[v] of the 256 pixel values, and the
+    transposed hed_from_rgb matrix for cv2.transform, in dtype. od() comes
+    from separate_stains itself, so the table follows whichever skimage is
+    installed. Built once per dtype.
+    :param dtype:
+    :return: (od, matrix, clip) where clip says whether stains are clipped at 0
+    """
+    if dtype not in HED_LUTS:
+        ramp = np.repeat(np.arange(256, dtype=np.uint8), 3).reshape(1, 256, 3)
+        od = separate_stains(ramp, np.eye(3))[0, :, 0]
+        # Newer skimage clips negative stains to 0 after the projection
+        probe = separate_stains(np.full((1, 1, 3), 128, dtype=np.uint8), -np.eye(3))
+        HED_LUTS[dtype] = (np.ascontiguousarray(od.reshape(256, 1), dtype=dtype),
+                           np.ascontiguousarray(hed_from_rgb.T, dtype=dtype), bool(np.all(probe == 0)))
+    return HED_LUTS[dtype]
 
-    elapsed_time = time.time() - start_time
-    print('Time it takes to read slide: ', elapsed_time)
-    start_time = time.time()  # reset
 
-    # Iterate through tile data
-    for key, val in tile_data.items():
-        # Create patches
-        do_tiles(val, slide)
-        # exit(0)  # TESTING ONE.
+def rgb_to_hed(rgb, dtype=np.float64):
+    """
+    separate_stains(rgb, hed_from_rgb) as one cv2.LUT of the optical
+    densities and one per-pixel matrix product.
+    :param rgb:
+    :param dtype:
+    :return:
+    """
+    od, matrix, clip = get_hed_lut(dtype)
+    hed = cv2.transform(cv2.LUT(rgb, od), matrix)
+    if clip:
+        np.maximum(hed, 0, out=hed)
+    return hed
 
-    slide.close()
 
-    elapsed_time = time.time() - start_time
-    print('Runtime calculate: ')
-    print(time.strftime("%H:%M:%S", time.gmtime(elapsed_time)))
+def rgb_to_hematoxylin(rgb, dtype=np.float64):
+    """
+    Hematoxylin channel of separate_stains(rgb, hed_from_rgb), using only
+    the hematoxylin row of the matrix.
+    :param rgb:
+    :param dtype:
+    :return:
+    """
+    od, matrix, clip = get_hed_lut(dtype)
+    hematoxylin = cv2.transform(cv2.LUT(rgb, od), matrix[:1])
+    if clip:
+        np.maximum(hematoxylin, 0, out=hematoxylin)
+    return hematoxylin
 
 
 def rgb_to_stain(rgb_img_matrix, sizex, sizey):
@@ -541,48 +1393,133 @@ def rgb_to_stain(rgb_img_matrix, sizex, sizey):
     :param sizey:
     :return:
     """
+    if STAIN_ENGINE == 'lut':
+        return rgb_to_hematoxylin(rgb_img_matrix, STAIN_DTYPE)
+
     hed_title_img = separate_stains(rgb_img_matrix, hed_from_rgb)
-    hematoxylin_img_array = [[0 for x in range(sizex)] for y in range(sizey)]
-    for index1, row in enumerate(hed_title_img):
-        for index2, pixel in enumerate(row):
-            hematoxylin_img_array[index1][index2] = pixel[0]
+    return hed_title_img[:, :, 0]
+
+
+def read_region_arrays(slide, location, size, level=0):
+    """
+    Read a region and decode it once into grayscale and RGB arrays.
+    :param slide:
+    :param location: level 0 coordinates
+    :param size: level 0 size, scaled down to the level read
+    :param level: pyramid level
+    :return:
+    """
+    if level:
+        downsample = slide.level_downsamples[level]
+        size = (max(int(round(size[0] / downsample)), 1), max(int(round(size[1] / downsample)), 1))
+    with METRICS.timer('slide_read'):
+        # read_region returns an RGBA Image (PIL)
+        region = slide.read_region(location, level, size)
+        gray, rgb = np.asarray(region.convert('L')), np.asarray(region.convert('RGB'))
+    METRICS.count('pixels_read', size[0] * size[1])
+    return gray, rgb
 
-    return hematoxylin_img_array
+
+def histogram_stats(values, percentiles=()):
+    """
+    Mean, std and percentiles of uint8 pixels from one bincount histogram,
+    instead of a pass over the pixels for each statistic. Percentiles
+    interpolate linearly between ranks, like np.percentile.
+    :param values: uint8 pixels
+    :param percentiles:
+    :return: mean, std, array of percentiles
+    """
+    counts = np.bincount(values.ravel(), minlength=256)
+    n = counts.sum()
+    levels = np.arange(len(counts), dtype=np.float64)
+    mean = np.dot(counts, levels) / n
+    std = math.sqrt(np.dot(counts, (levels - mean) ** 2) / n)
+
+    # The value of sorted rank k is the first level whose cumulative count exceeds k
+    cdf = np.cumsum(counts)
+    ranks = np.asarray(percentiles, dtype=np.float64) / 100 * (n - 1)
+    lower = np.floor(ranks)
+    low_value = np.searchsorted(cdf, lower, side='right')
+    high_value = np.searchsorted(cdf, np.minimum(lower + 1, n - 1), side='right')
+    return mean, std, low_value + (ranks - lower) * (high_value - low_value)
+
+
+def add_histogram_stats(data, name_prefix, img_array, percentiles):
+    """
+    Store <name_prefix>_patch_mean, _std and _percentile_<p> in data.
+    :param data:
+    :param name_prefix:
+    :param img_array:
+    :param percentiles:
+    :return:
+    """
+    if img_array.dtype == np.uint8:
+        patch_mean, patch_std, values = histogram_stats(img_array, percentiles)
+    else:
+        patch_mean = np.mean(img_array)
+        patch_std = np.std(img_array)
+        # All percentiles from a single partition of the array
+        values = np.percentile(img_array, percentiles) if len(percentiles) else []
+
+    data[name_prefix + '_patch_mean'] = patch_mean
+    data[name_prefix + '_patch_std'] = patch_std
+    for percentile, value in zip(percentiles, values):
+        data[name_prefix + '_patch_percentile_' + str(percentile)] = float(value)
+    return data
 
 
-def patch_operations(patch, mydoc):
-    # Convert to grayscale
-    img = patch.convert('L')
-    # img to array
-    img_array = np.array(img)
+def rgb_to_stains(rgb):
+    """
+    HED stain separation with the configured engine.
+    :param rgb: RGB pixels
+    :return:
+    """
+    with METRICS.timer('stain'):
+        if STAIN_ENGINE == 'lut':
+            return rgb_to_hed(rgb, STAIN_DTYPE)
+        return separate_stains(rgb, hed_from_rgb)
+
+
+def hematoxylin_uint8(rgb):
+    """
+    Hematoxylin channel scaled to 0-255 by the min and max of all three stains.
+    :param rgb: RGB pixels
+    :return:
+    """
+    hed_title_img = rgb_to_stains(rgb)
+    with METRICS.timer('stain'):
+        max1 = np.max(hed_title_img)
+        min1 = np.min(hed_title_img)
+        new_img_array = hed_title_img[:, :, 0]
+        return ((new_img_array - min1) * 255 / (max1 - min1)).astype(np.uint8)
+
+
+def patch_operations(gray, rgb, mydoc):
+    """
+    Grayscale and hematoxylin statistics of one patch.
+    :param gray: grayscale pixels
+    :param rgb: RGB pixels
+    :param mydoc:
+    :return:
+    """
     # Intensity for all pixels, divided by num pixels
-    mydoc['grayscale_patch_mean'] = np.mean(img_array)
-    mydoc['grayscale_patch_std'] = np.std(img_array)
+    add_histogram_stats(mydoc, 'grayscale', gray, PERCENTILES or [])
     # Intensity for all pixels inside segmented objects...
     # mydoc.grayscale_segment_mean = "n/a"
     # mydoc.grayscale_segment_std = "n/a"
 
-    # Convert to RGB
-    img = patch.convert('RGB')
-    img_array = np.array(img)
-    hed_title_img = separate_stains(img_array, hed_from_rgb)
-    max1 = np.max(hed_title_img)
-    min1 = np.min(hed_title_img)
-    new_img_array = hed_title_img[:, :, 0]
-    new_img_array = ((new_img_array - min1) * 255 / (max1 - min1)).astype(np.uint8)
-    mydoc['hematoxylin_patch_mean'] = np.mean(new_img_array)
-    mydoc['hematoxylin_patch_std'] = np.std(new_img_array)
+    new_img_array = hematoxylin_uint8(rgb)
+    add_histogram_stats(mydoc, 'hematoxylin', new_img_array, PERCENTILES or [])
     # mydoc.Hematoxylin_segment_mean = "n/a"
     # mydoc.Hematoxylin_segment_std = "n/a"
 
     return mydoc
 
 
-def tile_operations(patch, type, name_prefix, w, h):
+def tile_operations(img_array, name_prefix, w, h):
     """
 
-    :param patch:
-    :param type:
+    :param img_array: grayscale pixels, or RGB pixels for hematoxylin
     :param name_prefix:
     :param w:
     :param h:
@@ -590,31 +1527,12 @@ def tile_operations(patch, type, name_prefix, w, h):
     """
     data = {}
 
-    img = patch.convert(type)
-
-    # img to array
-    img_array = np.array(img)
-
     if name_prefix == 'hematoxylin':
         # Convert rgb to stain color space
         img_array = rgb_to_stain(img_array, w, h)
 
-    # average of the array elements
-    patch_mean = np.mean(img_array)
-    data[name_prefix + '_patch_mean'] = patch_mean
-
-    # standard deviation of the array elements
-    patch_std = np.std(img_array)
-    data[name_prefix + '_patch_std'] = patch_std
-
-    percentiles = [10, 25, 50, 75, 90]
-    for i in range(len(percentiles)):
-        name = name_prefix + '_patch_percentile_' + str(percentiles[i])
-        data[name] = np.percentile(img_array, percentiles[i])
-        # print(name_prefix + " patch {} percentile: {}".format(percentiles[i],
-        # np.percentile(img_array, percentiles[i])))
-
-    return data
+    # mean, standard deviation and percentiles of the array elements
+    return add_histogram_stats(data, name_prefix, img_array, PERCENTILES or DEFAULT_PERCENTILES)
 
 
 def histology(slide, min_x, min_y, w, h):
@@ -629,12 +1547,11 @@ def histology(slide, min_x, min_y, w, h):
     """
     rtn_obj = {}
     try:
-        # read_region returns an RGBA Image (PIL)
-        tile = slide.read_region((min_x, min_y), 0, (w, h))
+        gray, rgb = read_region_arrays(slide, (min_x, min_y), (w, h))
 
-        # convert image and perform calculations
-        a = tile_operations(tile, 'L', 'grayscale', w, h)
-        b = tile_operations(tile, 'RGB', 'hematoxylin', w, h)
+        # perform calculations
+        a = tile_operations(gray, 'grayscale', w, h)
+        b = tile_operations(rgb, 'hematoxylin', w, h)
         c = {}
 
         for (key, value) in a.items():
@@ -646,114 +1563,674 @@ def histology(slide, min_x, min_y, w, h):
         rtn_obj = c
 
     except Exception as e:
-        print('Error reading region: ', min_x, min_y)
-        print(e)
+        LOG.error('Error reading region: %s %s: %s', min_x, min_y, e)
         exit(1)
 
     return rtn_obj
 
 
-def detect_bright_spots(gray):
+def detect_bright_spots(gray, ksize=11):
     """
     Detect bright spots (no staining) and ignore those areas in area computation
     :param gray:
-    :return:
+    :param ksize: blur kernel size, odd; 1 for no blur
+    :return: boolean mask of the bright pixels
     """
     # load the image, convert it to grayscale, and blur it
     # image = cv2.imread('img/detect_bright_spots.png')
     # gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    blurred = cv2.GaussianBlur(gray, (11, 11), 0)
+    blurred = cv2.GaussianBlur(gray, (ksize, ksize), 0) if ksize > 1 else gray
     # Pixel values p >= 200 are set to 255 (white)
     # Pixel values < 200 are set to 0 (black).
     thresh = cv2.threshold(blurred, 200, 255, cv2.THRESH_BINARY)[1]
 
-    # Do something.
+    return thresh > 0
 
 
-def do_tiles(data, slide):
+def get_tissue_map(slide, data):
     """
-    Divide tile into patches
+    Tissue (not bright) mask of the tile's patch grids at 1 / TISSUE_DOWNSAMPLE
+    scale, read from the closest pyramid level rather than level 0.
+    :param slide:
     :param data:
+    :return: (summed-area table, origin x, origin y, level 0 px per cell x, y), or None
+    """
+    min_x = data['tile_minx'] + min(PATCH_SIZES)
+    min_y = data['tile_miny'] + min(PATCH_SIZES)
+    w = max((int(data['tile_width'] / size) + 1) * size for size in PATCH_SIZES) - min(PATCH_SIZES)
+    h = max((int(data['tile_height'] / size) + 1) * size for size in PATCH_SIZES) - min(PATCH_SIZES)
+    if w <= 0 or h <= 0:
+        return None
+
+    level = slide.get_best_level_for_downsample(TISSUE_DOWNSAMPLE)
+    level_downsample = slide.level_downsamples[level]
+    size = (int(math.ceil(w / level_downsample)), int(math.ceil(h / level_downsample)))
+    gray = np.asarray(slide.read_region((min_x, min_y), level, size).convert('L'))
+
+    # Bring the level to exactly the wanted scale
+    cells = (int(math.ceil(w / float(TISSUE_DOWNSAMPLE))), int(math.ceil(h / float(TISSUE_DOWNSAMPLE))))
+    if (gray.shape[1], gray.shape[0]) != cells:
+        gray = cv2.resize(gray, cells, interpolation=cv2.INTER_AREA)
+
+    # Downsampling already smooths, so the blur shrinks with the scale
+    ksize = int(round(11.0 / TISSUE_DOWNSAMPLE)) | 1
+    tissue = (~detect_bright_spots(gray, ksize)).astype(np.uint8)
+    return cv2.integral(tissue), min_x, min_y, w / float(cells[0]), h / float(cells[1])
+
+
+def get_tissue_fraction(tissue_map, minx, miny, maxx, maxy):
+    """
+    Fraction of a level 0 rectangle that is tissue, from get_tissue_map.
+    :param tissue_map:
+    :param minx:
+    :param miny:
+    :param maxx:
+    :param maxy:
     :return:
     """
-    print('Dividing patch into tiles...')
-    start_time = time.time()
+    table, origin_x, origin_y, cell_w, cell_h = tissue_map
+    rows, cols = table.shape[0] - 1, table.shape[1] - 1
+    c0 = min(max(int(round((minx - origin_x) / cell_w)), 0), cols)
+    c1 = min(max(int(round((maxx - origin_x) / cell_w)), c0 + 1), cols)
+    r0 = min(max(int(round((miny - origin_y) / cell_h)), 0), rows)
+    r1 = min(max(int(round((maxy - origin_y) / cell_h)), r0 + 1), rows)
+    if c1 <= c0 or r1 <= r0:
+        return 0.0
+    covered = table[r1, c1] - table[r0, c1] - table[r1, c0] + table[r0, c0]
+    return float(covered) / ((c1 - c0) * (r1 - r0))
+
+
+def get_tumor_mask_cell():
+    """
+    Side of the tumor mask cells: the smallest patch size / TUMOR_MASK_SUBDIV.
+    :return:
+    """
+    return min(PATCH_SIZES) / float(TUMOR_MASK_SUBDIV)
+
+
+def build_tumor_mask(tumor_list):
+    """
+    Rasterize the (normalized) tumor polygons onto a slide-wide grid of
+    get_tumor_mask_cell() pixel cells, as the part of each cell covered by
+    tumor in TUMOR_MASK_UNIT units. Cells clear of every outline are 0 or 1 by their fill; cells
+    on or next to an outline get their exact area from shapely, so every
+    cell a polygon touches is marked.
+    :param tumor_list:
+    :return: summed-area table of the mask, see get_tumor_overlap
+    """
+    cell = get_tumor_mask_cell()
+    fill = np.zeros((int(math.ceil(image_height / cell)), int(math.ceil(image_width / cell))), dtype=np.uint8)
+    edge = np.zeros_like(fill)
+    shift = 4  # fractional bits of the cv2 point coordinates
+    scale = np.array([image_width / cell, image_height / cell]) * (1 << shift)
+
+    outlines = []
+    shapes = []
+    for tumor_roi in tumor_list:
+        if tumor_roi.is_empty:
+            continue
+        coords = np.asarray(tumor_roi.exterior.coords)[:, :2]
+        outlines.append(np.round(coords * scale).astype(np.int32))
+        shapes.append(Polygon(coords).buffer(0))
+    # One fillPoly per outline: a single call fills even-odd, leaving overlaps of two markups as holes
+    for outline in outlines:
+        cv2.fillPoly(fill, [outline], 1, cv2.LINE_8, shift)
+    if outlines:
+        cv2.polylines(edge, outlines, True, 1, 1, cv2.LINE_8, shift)
+        # The 8-connected outline can step diagonally past a cell it clips at the corner
+        edge = cv2.dilate(edge, np.ones((3, 3), np.uint8))
+
+    mask = fill.astype(np.int64) * TUMOR_MASK_UNIT
+    rows, cols = np.nonzero(edge)
+    mask[rows, cols] = 0
+    if len(rows):
+        tumor = unary_union(shapes)
+        cell_w, cell_h = cell / image_width, cell / image_height
+        # Cut the tumor into one strip per mask row first; a cell is then intersected with a small piece
+        for r in np.unique(rows):
+            strip = tumor.intersection(box(0.0, r * cell_h, mask.shape[1] * cell_w, (r + 1) * cell_h))
+            if strip.is_empty:
+                continue
+            strip_prep = prep(strip)
+            for c in cols[rows == r]:
+                cell_box = box(c * cell_w, r * cell_h, (c + 1) * cell_w, (r + 1) * cell_h)
+                if strip_prep.contains(cell_box):
+                    mask[r, c] = TUMOR_MASK_UNIT
+                elif strip_prep.intersects(cell_box):
+                    # Rounded up, so a cell the outline only touches is still marked
+                    area = strip.intersection(cell_box).area / cell_box.area
+                    mask[r, c] = max(int(math.ceil(area * TUMOR_MASK_UNIT)), 1)
+
+    LOG.info('Tumor mask %s cells of %s px, %s marked (%s on an outline)', mask.shape, cell,
+             int(np.count_nonzero(mask)), len(rows))
+    table = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype=np.int64)
+    table[1:, 1:] = mask.cumsum(axis=0).cumsum(axis=1)
+    return table
+
+
+def get_tumor_overlap(minx, miny, maxx, maxy):
+    """
+    Fraction of a level 0 rectangle covered by tumor, from the TUMOR_MASK
+    cells it overlaps; exact for rectangles on the cell grid. 0.0 means
+    clear of every tumor outline.
+    :param minx:
+    :param miny:
+    :param maxx:
+    :param maxy:
+    :return:
+    """
+    cell = get_tumor_mask_cell()
+    rows, cols = TUMOR_MASK.shape[0] - 1, TUMOR_MASK.shape[1] - 1
+    c0 = min(max(int(math.floor(minx / cell)), 0), cols)
+    c1 = min(max(int(math.ceil(maxx / cell)), 0), cols)
+    r0 = min(max(int(math.floor(miny / cell)), 0), rows)
+    r1 = min(max(int(math.ceil(maxy / cell)), 0), rows)
+    covered = TUMOR_MASK[r1, c1] - TUMOR_MASK[r0, c1] - TUMOR_MASK[r1, c0] + TUMOR_MASK[r0, c0]
+    return min(float(covered) / TUMOR_MASK_UNIT * cell * cell / ((maxx - minx) * (maxy - miny)), 1.0)
+
+
+def segment_stats(df, nuclei, patches):
+    """
+    Mean and std of every segment feature, for all patches of a tile in one
+    grouped reduction. Like pandas, NaNs are skipped and std uses ddof=1.
+    :param df: nuclei of the tile
+    :param nuclei: row position of each (nucleus, patch) membership
+    :param patches: patch number of each (nucleus, patch) membership
+    :return: {patch_num: {field: value}}
+    """
+    if not nuclei:
+        return {}
+
+    columns = [column for column, _ in SEGMENT_FEATURES]
+    nuclei = np.asarray(nuclei)
+    patches = np.asarray(patches)
+
+    # Group memberships by patch
+    order = np.argsort(patches, kind='mergesort')
+    patches = patches[order]
+    values = df[columns].values.astype(np.float64)[nuclei[order]]
+    starts = np.flatnonzero(np.r_[True, patches[1:] != patches[:-1]])
+    group = np.cumsum(np.r_[False, patches[1:] != patches[:-1]])
+
+    valid = ~np.isnan(values)
+    count = np.add.reduceat(valid, starts).astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.add.reduceat(np.where(valid, values, 0.0), starts) / count
+        dev = np.where(valid, values - mean[group], 0.0)
+        std = np.sqrt(np.add.reduceat(dev * dev, starts) / (count - 1))
+    mean[count == 0] = np.nan
+    std[count <= 1] = np.nan
+
+    rtn_obj = {}
+    for g, patch_num in enumerate(patches[starts]):
+        data = {}
+        for i, (_, prefix) in enumerate(SEGMENT_FEATURES):
+            data[prefix + '_segment_mean'] = mean[g, i]
+            data[prefix + '_segment_std'] = std[g, i]
+        rtn_obj[int(patch_num)] = data
+
+    return rtn_obj
+
+
+def patch_cell_range(lo, hi, origin, size):
+    """
+    Index range of the patch cells [origin + i * size, origin + (i + 1) * size]
+    touched by the interval [lo, hi] (cells sharing only an edge included).
+    :param lo:
+    :param hi:
+    :param origin:
+    :param size:
+    :return:
+    """
+    first = int(math.ceil((lo - origin) / float(size))) - 1
+    last = int(math.floor((hi - origin) / float(size)))
+    return first, last
+
+
+def build_patch_index(shapes, origin_x, origin_y, size, cols, rows):
+    """
+    Grid buckets keyed by patch cell (x, y), holding the positions of the
+    nuclei whose bounding box touches that cell. Positions stay in row order.
+    :param shapes:
+    :param origin_x:
+    :param origin_y:
+    :param size:
+    :param cols:
+    :param rows:
+    :return:
+    """
+    buckets = {}
+    for pos, shape in enumerate(shapes):
+        if shape.is_empty:
+            continue
+        minx, miny, maxx, maxy = shape.bounds
+        x0, x1 = patch_cell_range(minx, maxx, origin_x, size)
+        y0, y1 = patch_cell_range(miny, maxy, origin_y, size)
+        for x in range(max(x0, 1), min(x1, cols) + 1):
+            for y in range(max(y0, 1), min(y1, rows) + 1):
+                buckets.setdefault((x, y), []).append(pos)
+    return buckets
+
+
+def rasterize_nuclei(coords, offsets, origin_x, origin_y, cols, rows, size):
+    """
+    Nuclear pixel count of every patch in a cols x rows grid of size px
+    patches starting at (origin_x, origin_y). All nuclei are scan-converted
+    at once (even-odd rule, pixel centers) into pixel spans; the spans of
+    each row are merged, so overlapping nuclei count once, and summed per
+    patch cell without building a pixel mask.
+    :param coords:
+    :param offsets:
+    :param origin_x:
+    :param origin_y:
+    :param cols:
+    :param rows:
+    :param size:
+    :return: (rows, cols) array of pixel counts
+    """
+    height, width = rows * size, cols * size
+    counts = np.zeros((rows, cols), dtype=np.int64)
+    sizes = np.diff(offsets)
+    if not len(sizes):
+        return counts
+
+    # Every polygon edge, closing each ring, tagged with its nucleus
+    points = coords - np.array([origin_x, origin_y])
+    nucleus = np.repeat(np.arange(len(sizes)), sizes)
+    following = np.arange(1, len(points) + 1)
+    following[offsets[1:] - 1] = offsets[:-1]
+    keep = np.repeat(sizes >= 3, sizes)
+    x1, y1 = points[keep, 0], points[keep, 1]
+    x2, y2 = points[following[keep], 0], points[following[keep], 1]
+    nucleus = nucleus[keep]
+
+    # Pixel rows whose centers (j + 0.5) each edge crosses, half-open in y
+    first = np.clip(np.ceil(np.minimum(y1, y2) - 0.5), 0, height).astype(np.int64)
+    last = np.clip(np.ceil(np.maximum(y1, y2) - 0.5), 0, height).astype(np.int64)
+    spans = last - first
+    if not spans.sum():
+        return counts
+    edge = np.repeat(np.arange(len(spans)), spans)
+    row = first[edge] + np.arange(spans.sum()) - np.repeat(np.cumsum(spans) - spans, spans)
+    yc = row + 0.5
+    xc = x1[edge] + (yc - y1[edge]) * (x2[edge] - x1[edge]) / (y2[edge] - y1[edge])
+
+    # Pair up the crossings of each nucleus row: pixels with centers in [a, b)
+    order = np.lexsort((xc, row, nucleus[edge]))
+    xc, row = xc[order], row[order]
+    start = np.clip(np.ceil(xc[0::2] - 0.5), 0, width).astype(np.int64)
+    end = np.clip(np.ceil(xc[1::2] - 0.5), 0, width).astype(np.int64)
+    row = row[0::2]
+    filled = start < end
+    row, start, end = row[filled], start[filled], end[filled]
+    if not len(row):
+        return counts
+
+    # Union of the spans of each row: sorted by start, each span only adds what lies past the
+    # furthest end before it. Offsetting by row keeps the running maximum within the row.
+    order = np.lexsort((start, row))
+    row, start, end = row[order], start[order], end[order]
+    reach = np.maximum.accumulate(row * (width + 1) + end) - row * (width + 1)
+    before = np.concatenate([[0], reach[:-1]])
+    before[np.concatenate([[True], row[1:] != row[:-1]])] = 0
+    lo, hi = np.maximum(start, before), np.maximum(end, before)
+    keep = lo < hi
+    row, lo, hi = row[keep], lo[keep], hi[keep]
+
+    # Pixel count of each piece in every patch column it crosses
+    pieces = (hi - 1) // size - lo // size + 1
+    piece = np.repeat(np.arange(len(lo)), pieces)
+    col = lo[piece] // size + np.arange(pieces.sum()) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    length = np.minimum(hi[piece], (col + 1) * size) - np.maximum(lo[piece], col * size)
+    cells = np.bincount((row[piece] // size) * cols + col, weights=length, minlength=rows * cols)
+    return np.round(cells).astype(np.int64).reshape(rows, cols)
+
+
+def nest_patch_sizes(patch_sizes):
+    """
+    Group the patch sizes by the grid their nuclei are computed on: the
+    smallest size, for every size that is a multiple of it, so larger
+    patches are sums of its cells. Other sizes get a grid of their own.
+    :param patch_sizes:
+    :return: list of (cell size, [patch sizes])
+    """
+    groups = []
+    for size in sorted(set(patch_sizes)):
+        for base, sizes in groups:
+            if size % base == 0:
+                sizes.append(size)
+                break
+        else:
+            groups.append((size, [size]))
+    return groups
+
+
+def get_cell_nuclei(data, shapes, size, cells, cols, rows):
+    """
+    Nuclei intersecting each of the given size px patch cells (x, y) of a
+    tile, and the summed area of those intersections.
+    :param data:
+    :param shapes:
+    :param size:
+    :param cells:
+    :param cols: grid extent, at least the largest x in cells
+    :param rows:
+    :return: ({(x, y): [nucleus positions]}, {(x, y): area})
+    """
+    # Index nuclei by the patch cells they can overlap
+    patch_index = build_patch_index(shapes, data['tile_minx'], data['tile_miny'], size, cols, rows)
+
+    members = {}
+    areas = {}
+    for (x, y) in cells:
+        minx = x * size + data['tile_minx']
+        miny = y * size + data['tile_miny']
+        maxx = minx + size
+        maxy = miny + size
+
+        # Bounding box representing patch
+        bbox = Polygon([(minx, miny), (maxx, miny), (maxx, maxy), (minx, maxy), (minx, miny)])
+
+        nucleus_area = 0.0
+        cell_members = []
+        # Figure out which polygons (data rows) belong to which patch;
+        # only the nuclei bucketed under this patch cell are candidates.
+        for pos in patch_index.get((x, y), []):
+            polygon_shape = shapes[pos]
+
+            # Accumulate information
+            if polygon_shape.intersects(bbox):
+                cell_members.append(pos)
+                try:
+                    nucleus_area += polygon_shape.intersection(bbox).area
+                except Exception as err:
+                    # except errors.TopologicalError as toperr:
+                    LOG.warning('Invalid geometry: %s', err)
+
+        members[(x, y)] = cell_members
+        areas[(x, y)] = nucleus_area
+    return members, areas
+
+
+def get_cell_members(data, coords, offsets, size, cells, cols, rows):
+    """
+    Nuclei intersecting each of the given size px patch cells (x, y) of a
+    tile, like get_cell_nuclei without the areas. A nucleus whose bounding
+    box lies inside one cell is a member of that cell outright; only nuclei
+    on a cell border are built as shapes and tested with shapely.
+    :param data:
+    :param coords:
+    :param offsets:
+    :param size:
+    :param cells:
+    :param cols: grid extent, at least the largest x in cells
+    :param rows:
+    :return: {(x, y): [nucleus positions]}
+    """
+    origin_x, origin_y = data['tile_minx'], data['tile_miny']
+    members = dict((cell, []) for cell in cells)
+    sizes = np.diff(offsets)
+    if not len(coords):
+        return members
+
+    # Bounding box and shoelace area of every nucleus, leaving empty ones to shapely
+    starts = np.minimum(offsets[:-1], len(coords) - 1)
+    following = np.arange(1, len(coords) + 1)
+    following[offsets[1:][sizes > 0] - 1] = offsets[:-1][sizes > 0]
+    x, y = coords[:, 0], coords[:, 1]
+    area = np.add.reduceat(x * y[following] - x[following] * y, starts)
+    first_x = np.ceil((np.minimum.reduceat(x, starts) - origin_x) / size).astype(np.int64) - 1
+    last_x = np.floor((np.maximum.reduceat(x, starts) - origin_x) / size).astype(np.int64)
+    first_y = np.ceil((np.minimum.reduceat(y, starts) - origin_y) / size).astype(np.int64) - 1
+    last_y = np.floor((np.maximum.reduceat(y, starts) - origin_y) / size).astype(np.int64)
+    inside = (sizes > 0) & (area != 0) & (first_x == last_x) & (first_y == last_y)
+
+    for pos in np.flatnonzero(inside):
+        cell = (int(first_x[pos]), int(first_y[pos]))
+        if cell in members:
+            members[cell].append(int(pos))
+
+    for pos in np.flatnonzero(~inside):
+        # Using a zero-width buffer cleans up many topology problems
+        polygon_shape = coords_to_polygon(coords, offsets, pos).buffer(0.0)
+        if polygon_shape.is_empty:
+            continue
+        minx, miny, maxx, maxy = polygon_shape.bounds
+        x0, x1 = patch_cell_range(minx, maxx, origin_x, size)
+        y0, y1 = patch_cell_range(miny, maxy, origin_y, size)
+        for cx in range(max(x0, 1), min(x1, cols) + 1):
+            for cy in range(max(y0, 1), min(y1, rows) + 1):
+                if (cx, cy) in members and polygon_shape.intersects(
+                        box(cx * size + origin_x, cy * size + origin_y, (cx + 1) * size + origin_x,
+                            (cy + 1) * size + origin_y)):
+                    members[(cx, cy)].append(int(pos))
+
+    # In row order, like get_cell_nuclei
+    for cell_members in members.values():
+        cell_members.sort()
+    return members
+
+
+def get_stats_level(slide):
+    """
+    Pyramid level the patch intensity statistics are read from: the level
+    closest to STATS_MPP, else STATS_LEVEL (level 0 by default).
+    :param slide:
+    :return:
+    """
+    if STATS_MPP:
+        return slide.get_best_level_for_downsample(STATS_MPP / mpp_x)
+    return min(STATS_LEVEL, slide.level_count - 1)
+
+
+def patch_histology(slide, patches, level=0):
+    """
+    Grayscale and hematoxylin statistics of the patches of one tile, from
+    pixels of the given pyramid level. Patch boxes stay in level 0
+    coordinates and are scaled to the level.
+    :param slide:
+    :param patches: patch_data dicts (patch_minx, patch_miny, patch_size)
+    :param level:
+    :return: list of {field: value}, one per patch
+    """
+    if not patches:
+        return []
+
+    downsample = slide.level_downsamples[level]
+    if READ_MODE == 'patch':
+        rtn_list = []
+        for patch_data in patches:
+            gray, rgb = read_region_arrays(slide, (patch_data['patch_minx'], patch_data['patch_miny']),
+                                           (patch_data['patch_size'], patch_data['patch_size']), level)
+            rtn_list.append(patch_operations(gray, rgb, {}))
+        return rtn_list
+
+    # Decode the region under all (kept) patches once; patches are views into it
+    origin_x = min(patch_data['patch_minx'] for patch_data in patches)
+    origin_y = min(patch_data['patch_miny'] for patch_data in patches)
+    region_w = max(patch_data['patch_minx'] + patch_data['patch_size'] for patch_data in patches) - origin_x
+    region_h = max(patch_data['patch_miny'] + patch_data['patch_size'] for patch_data in patches) - origin_y
+    tile_gray, tile_rgb = read_region_arrays(slide, (origin_x, origin_y), (region_w, region_h), level)
+
+    # Patch boxes in pixels of the level read
+    boxes = []
+    for patch_data in patches:
+        x0 = patch_data['patch_minx'] - origin_x
+        y0 = patch_data['patch_miny'] - origin_y
+        size = patch_data['patch_size']
+        boxes.append([min(int(round(x0 / downsample)), tile_gray.shape[1] - 1),
+                      min(int(round(y0 / downsample)), tile_gray.shape[0] - 1),
+                      min(max(int(round((x0 + size) / downsample)), 1), tile_gray.shape[1]),
+                      min(max(int(round((y0 + size) / downsample)), 1), tile_gray.shape[0])])
+    boxes = np.array(boxes)
+    # At least one pixel per patch
+    boxes[:, 2] = np.maximum(boxes[:, 2], boxes[:, 0] + 1)
+    boxes[:, 3] = np.maximum(boxes[:, 3], boxes[:, 1] + 1)
+
+    return [patch_operations(tile_gray[y0:y1, x0:x1], tile_rgb[y0:y1, x0:x1], {}) for x0, y0, x1, y1 in boxes]
+
+
+def report_stats_level(slide, docs, level):
+    """
+    Print how far the intensity statistics of docs (read at level) are
+    from the same statistics read at level 0.
+    :param slide:
+    :param docs: patch documents of whole tiles
+    :param level:
+    :return:
+    """
+    tiles = {}
+    for mydoc in docs:
+        tiles.setdefault((mydoc['tile_minx'], mydoc['tile_miny']), []).append(mydoc)
+
+    deltas = {}
+    for tile_docs in tiles.values():
+        patches = [{'patch_minx': mydoc['patch_min_x_pixel'], 'patch_miny': mydoc['patch_min_y_pixel'],
+                    'patch_size': mydoc['patch_size']} for mydoc in tile_docs]
+        for mydoc, histology in zip(tile_docs, patch_histology(slide, patches, 0)):
+            for name, value in histology.items():
+                deltas.setdefault(name, []).append(abs(mydoc[name] - value))
+
+    LOG.info('Level %s (downsample %g) vs level 0 intensity statistics over %s patches:', level,
+             slide.level_downsamples[level], len(docs))
+    for name in sorted(deltas):
+        LOG.info('  %s: mean abs diff %.4f, max abs diff %.4f', name, np.mean(deltas[name]), np.max(deltas[name]))
+
 
-    patch_num = 0
+def do_tiles(data, slide):
+    """
+    Divide tile into patches, for every size in PATCH_SIZES. Nuclei are
+    matched once on the grid of the smallest size, and larger sizes that
+    are multiples of it add up its cells; all sizes share one pixel read.
+    :param data:
+    :param slide:
+    :return: patch documents
+    """
     df = data['df']
+    METRICS.count('nuclei', len(df))
     width = data['tile_width']
     height = data['tile_height']
-    cols = width / PATCH_SIZE
-    rows = height / PATCH_SIZE
     # data_complete = {}
 
+    # Build every nucleus geometry once per tile, from the coordinates parsed by aggregate_data
+    coords, offsets = data['coords'], data['offsets']
+    shapes = []
+    # Raster mode only builds the shapes of nuclei on a patch border, see get_cell_members
+    for i in range(len(df) if AREA_MODE != 'raster' else 0):
+        polygon_shape = coords_to_polygon(coords, offsets, i)
+        shapes.append(polygon_shape.buffer(0.0))  # Using a zero-width buffer cleans up many topology problems
+
+    # Tissue coverage from a downsampled view of the tile
+    tissue_map = None
+    if MIN_TISSUE is not None:
+        with METRICS.timer('tissue_filter'):
+            tissue_map = get_tissue_map(slide, data)
+
     # Divide tile into patches
-    for x in range(1, (int(cols) + 1)):
-        for y in range(1, (int(rows) + 1)):
-            patch_num += 1
-            print('patch_num', patch_num)
-            # minx = minx + (x * tile_size)
-            # miny = miny + (y * tile_size)
-            minx = x * PATCH_SIZE
-            miny = y * PATCH_SIZE
-            minx = minx + data['tile_minx']
-            miny = miny + data['tile_miny']
-            maxx = minx + PATCH_SIZE
-            maxy = miny + PATCH_SIZE
-
-            # Normalize
-            nminx = minx / image_width
-            nminy = miny / image_width
-            nmaxx = maxx / image_width
-            nmaxy = maxy / image_width
-
-            # Bounding box representing patch
-            print((minx, miny), (maxx, miny), (maxx, maxy), (minx, maxy))
-            # bbox = BoundingBox([(minx, miny), (maxx, miny), (maxx, maxy), (minx, maxy)])
-            bbox = Polygon([(minx, miny), (maxx, miny), (maxx, maxy), (minx, maxy), (minx, miny)])
-            bbox1 = Polygon([(nminx, nminy), (nmaxx, nminy), (nmaxx, nmaxy), (nminx, nmaxy), (nminx, nminy)])
-
-            df2 = pandas.DataFrame()
-            nucleus_area = 0.0
-            # Figure out which polygons (data rows) belong to which patch
-            for index, row in df.iterrows():
-                xy = row['Polygon']
-                polygon_shape = string_to_polygon(xy, data['image_width'], data['image_height'], False)
-                polygon_shape = polygon_shape.buffer(0.0)  # Using a zero-width buffer cleans up many topology problems
-                # polygon_shape1 = string_to_polygon(xy, data['image_width'], data['image_height'], True)
-                # polygon_shape1 = polygon_shape1.buffer(0.0)
-
-                # print('polygon_shape', polygon_shape)
-
-                # Accumulate information
-                if polygon_shape.within(bbox) or polygon_shape.intersects(bbox):
-                    df2 = df2.append(row)
-                    if polygon_shape.intersects(bbox):
-                        try:
-                            nucleus_area += polygon_shape.intersection(bbox).area
-                            # nucleus_area += polygon_shape1.intersection(bbox1).area
-                            # print(nucleus_area * factor)
-                        except Exception as err:
-                            # except errors.TopologicalError as toperr:
-                            print('Invalid geometry', err)
-                    else:
-                        nucleus_area += polygon_shape.area
-                        # nucleus_area += polygon_shape1.area
-                        # print(nucleus_area * factor)
-
-            nucleus_area = nucleus_area / PATCH_SIZE
-            print('nucleus_area', nucleus_area)
-
-            update_db(slide, {'df': df2, 'nucleus_area': nucleus_area, 'patch_num': patch_num,
-                              'patch_minx': minx, 'patch_miny': miny, 'tile_minx': data['tile_minx'],
-                              'tile_miny': data['tile_miny'], 'image_width': data['image_width'],
-                              'image_height': data['image_height']}, coll_name)
-
-    elapsed_time = time.time() - start_time
-    print('Runtime do_tiles: ')
-    print(time.strftime("%H:%M:%S", time.gmtime(elapsed_time)))
+    patches = []
+    for base, sizes in nest_patch_sizes(PATCH_SIZES):
+        # Patches kept at each size, and the base cells they cover
+        layout = []
+        cells = set()
+        for size in sizes:
+            ratio = size // base
+            cols = width / size
+            rows = height / size
+            patch_num = 0
+            for x in range(1, (int(cols) + 1)):
+                for y in range(1, (int(rows) + 1)):
+                    patch_num += 1
+                    minx = x * size + data['tile_minx']
+                    miny = y * size + data['tile_miny']
+
+                    tumor_overlap = None
+                    if TUMOR_MASK is not None:
+                        tumor_overlap = get_tumor_overlap(minx, miny, minx + size, miny + size)
+                        if TUMOR_CLIP and tumor_overlap == 0.0:
+                            # Patch is outside every tumor outline
+                            continue
+
+                    tissue_fraction = None
+                    if tissue_map is not None:
+                        tissue_fraction = get_tissue_fraction(tissue_map, minx, miny, minx + size, miny + size)
+                        if BLANK_PATCHES == 'skip' and tissue_fraction < MIN_TISSUE:
+                            # Mostly glass
+                            continue
+
+                    covered = [(i, j) for i in range(x * ratio, (x + 1) * ratio)
+                               for j in range(y * ratio, (y + 1) * ratio)]
+                    cells.update(covered)
+                    layout.append((size, patch_num, minx, miny, tumor_overlap, tissue_fraction, covered))
+        if not layout:
+            continue
+
+        cols = max(i for i, _ in cells)
+        rows = max(j for _, j in cells)
+        if AREA_MODE == 'raster':
+            members, areas = get_cell_members(data, coords, offsets, base, cells, cols, rows), None
+        else:
+            members, areas = get_cell_nuclei(data, shapes, base, cells, cols, rows)
+
+        # Raster nucleus area of every cell in one pass over the tile
+        raster_area = None
+        if AREA_MODE != 'vector':
+            raster_area = rasterize_nuclei(coords, offsets, data['tile_minx'] + base, data['tile_miny'] + base,
+                                           cols, rows, base)
+
+        member_nuclei = dict((size, []) for size in sizes)
+        member_patches = dict((size, []) for size in sizes)
+        size_patches = dict((size, []) for size in sizes)
+        for size, patch_num, minx, miny, tumor_overlap, tissue_fraction, covered in layout:
+            if len(covered) == 1:
+                nuclei = members[covered[0]]
+            else:
+                # A nucleus on a cell border belongs to the patch once
+                nuclei = sorted(set().union(*[members[cell] for cell in covered]))
+            member_nuclei[size].extend(nuclei)
+            member_patches[size].extend([patch_num] * len(nuclei))
+
+            if AREA_MODE == 'raster':
+                nucleus_area = float(sum(raster_area[j - 1, i - 1] for i, j in covered))
+            else:
+                nucleus_area = sum(areas[cell] for cell in covered)
+            nucleus_area = nucleus_area / size
+            patch_data = {'nucleus_area': nucleus_area, 'patch_num': patch_num, 'patch_size': size,
+                          'patch_minx': minx, 'patch_miny': miny, 'tile_minx': data['tile_minx'],
+                          'tile_miny': data['tile_miny'], 'image_width': data['image_width'],
+                          'image_height': data['image_height']}
+            if TUMOR_OVERLAP:
+                patch_data['tumor_overlap'] = tumor_overlap
+            if tissue_fraction is not None:
+                patch_data['tissue_fraction'] = tissue_fraction
+                if BLANK_PATCHES == 'flag':
+                    patch_data['blank'] = tissue_fraction < MIN_TISSUE
+            if AREA_MODE == 'compare':
+                patch_data['nucleus_area_raster'] = float(sum(raster_area[j - 1, i - 1] for i, j in covered)) / size
+            size_patches[size].append(patch_data)
+
+        # Segment statistics for every patch of the tile at once
+        for size in sizes:
+            stats = segment_stats(df, member_nuclei[size], member_patches[size])
+            for patch_data in size_patches[size]:
+                patch_data['segment_stats'] = stats.get(patch_data['patch_num'], {})
+            patches.extend(size_patches[size])
+
+    # Grayscale and hematoxylin statistics
+    with METRICS.timer('patch_stats'):
+        level = get_stats_level(slide)
+        for patch_data, histology in zip(patches, patch_histology(slide, patches, level)):
+            patch_data['histology'] = histology
+            patch_data['stats_level'] = level
+
+    docs = []
+    for patch_data in patches:
+        docs.append(build_patch_doc(slide, patch_data))
+
+    LOG.debug('Tile %s,%s: %s nuclei, %s patches', data['tile_minx'], data['tile_miny'], len(df), len(docs))
     # exit(0)  # testing one tile
 
+    return docs
+
 
 def get_image_metadata():
     p = Path(os.path.join(SLIDE_DIR, (CASE_ID + '.svs')))
@@ -770,76 +2247,455 @@ def get_image_metadata():
     return mpp_x, mpp_y, image_width, image_height
 
 
+def connect_db():
+    """
+    Open the MongoDB connection shared by every slide this process handles.
+    :return:
+    """
+    global CLIENT, DB
+    try:
+        CLIENT = mongodb_connect('mongodb://' + DB_HOST + ':27017')
+        CLIENT.server_info()  # force connection, trigger error to be caught
+        DB = CLIENT.quip_comp
+    except Exception as e:
+        LOG.error('Connection error: %s', e)
+        exit(1)
+
+
+def process_slide(case_id, staged=False, staging_seconds=0.0):
+    """
+    Run the whole pipeline for one slide, setting the per-slide globals
+    the functions above work from.
+    :param case_id:
+    :param staged: data was already copied by a Stager
+    :param staging_seconds: time the Stager took, for the metrics
+    :return: (list of (key, error) for the tiles that failed, number of documents that failed to write)
+    """
+    global CASE_ID, SLIDE_DIR, DATA_FILE_SUBFOLDERS, mpp_x, mpp_y, image_width, image_height, patch_polygon_area, \
+        TUMOR_MASK, METRICS
+    start_time = time.time()
+    METRICS = Metrics()
+    peak_scope = 'slide' if reset_peak_rss() else 'process'
+    CASE_ID = case_id
+    SLIDE_DIR = os.path.join(WORK_DIR, CASE_ID) + os.sep
+    DATA_FILE_SUBFOLDERS = get_file_list(CASE_ID, 'config/data_file_path.list')
+    # print('DATA_FILE_SUBFOLDERS', DATA_FILE_SUBFOLDERS)
+
+    # Fetch data.
+    if not staged:
+        assure_path_exists(SLIDE_DIR)
+        with METRICS.timer('staging'):
+            copy_src_data(SLIDE_DIR)
+    else:
+        METRICS.seconds['staging'] = staging_seconds
+
+    mpp_x, mpp_y, image_width, image_height = get_image_metadata()
+    patch_polygon_area = dict((size, size * size * mpp_x * mpp_y) for size in PATCH_SIZES)
+    LOG.debug('patch_polygon_area %s', patch_polygon_area)
+
+    with METRICS.timer('tumor_filter'):
+        # Find what the pathologist circled as tumor.
+        tumor_mark_list = get_tumor_markup(USER_NAME)
+        # print('tumor_mark_list', len(tumor_mark_list))
+
+        # List of Tumor polygons
+        tumor_poly_list = markup_to_polygons(tumor_mark_list)
+        # print('tumor_poly_list', len(tumor_poly_list))
+
+        # Patch-level tumor filter
+        TUMOR_MASK = build_tumor_mask(tumor_poly_list) if (TUMOR_CLIP or TUMOR_OVERLAP) else None
+
+    with METRICS.timer('manifest'):
+        # Fetch list of data files
+        JSON_FILES, CSV_INDEX = get_data_files()
+
+        # Tile geometry from the per-tile JSON files
+        manifest = load_tile_manifest(JSON_FILES)
+
+    # Identify only the files within the tumor regions
+    with METRICS.timer('tumor_filter'):
+        jfile_objs = get_poly_within(manifest, tumor_poly_list)
+    LOG.info('get_poly_within len: %s', len(jfile_objs))
+
+    # Tiles finished by an earlier run
+    checkpoint_path = get_checkpoint_path()
+    if RESUME:
+        done = read_checkpoint(checkpoint_path)
+        jfile_objs = dict((k, v) for k, v in jfile_objs.items() if get_tile_position(v) not in done)
+        LOG.info('Resuming: %s tiles already done, %s to go', len(done), len(jfile_objs))
+    elif os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    # Get data
+    csv_data = aggregate_data(jfile_objs, CSV_INDEX)
+    LOG.info('csv_data len: %s', len(csv_data))
+
+    # Calculate
+    failed_tiles = calculate(csv_data)
+    failed_docs = close_writers()
+
+    record = METRICS.report(CASE_ID, time.time() - start_time, peak_scope)
+    log_metrics(record)
+    write_metrics(record)
+
+    return failed_tiles, failed_docs
+
+
+def run_batch_slide(case_id, staged=False, staging_seconds=0.0):
+    """
+    process_slide for the batch driver: never raises, returns a status record.
+    :param case_id:
+    :param staged:
+    :param staging_seconds:
+    :return:
+    """
+    start_time = time.time()
+    status = {'case_id': case_id, 'status': 'done', 'failed_tiles': 0, 'failed_docs': 0, 'error': None}
+    try:
+        failed_tiles, failed_docs = process_slide(case_id, staged, staging_seconds)
+        status['failed_tiles'] = len(failed_tiles)
+        status['failed_docs'] = failed_docs
+        if failed_tiles or failed_docs:
+            status['status'] = 'partial'
+    except (Exception, SystemExit) as err:
+        status['status'] = 'failed'
+        status['error'] = '{}: {}'.format(type(err).__name__, err)
+        close_writers()
+    status['seconds'] = round(time.time() - start_time, 1)
+    return status
+
+
+def init_batch_worker():
+    """
+    Pool initializer: one database connection per batch worker, reused for all its slides.
+    :return:
+    """
+    global WORKERS
+    # Pool workers can't start pools of their own
+    WORKERS = 1
+    connect_db()
+
+
+def get_batch_cases(case_list):
+    """
+    Case IDs to run: from a file with one case ID per line, or every slide in config/image_path.list.
+    :param case_list:
+    :return:
+    """
+    if case_list:
+        with open(case_list) as f:
+            lines = [line.strip() for line in f]
+        f.close()
+        return [line for line in lines if line and not line.startswith('#')]
+
+    case_ids = []
+    for line in get_file_list('', 'config/image_path.list'):
+        if line:
+            case_id = os.path.splitext(os.path.basename(line))[0]
+            if case_id not in case_ids:
+                case_ids.append(case_id)
+    return case_ids
+
+
+def run_batch(case_ids):
+    """
+    Run several slides, CONCURRENCY at a time, recording each slide's status
+    in STATUS_FILE as it finishes. A Stager copies the next PREFETCH slides
+    while the current ones compute.
+    :param case_ids:
+    :return: status records
+    """
+    LOG.info('Batch of %s slides, %s at a time', len(case_ids), CONCURRENCY)
+    statuses = {}
+    lock = threading.Lock()
+    max_bytes = int(MAX_STAGED_GB * 1024 ** 3) if MAX_STAGED_GB else None
+    stager = Stager(case_ids, CONCURRENCY + PREFETCH, max_bytes)
+
+    def record(status):
+        with lock:
+            statuses[status['case_id']] = status
+            LOG.info('Slide {case_id}: {status} ({failed_tiles} failed tiles, {failed_docs} failed documents, '
+                     '{seconds}s)'.format(**status))
+            if status['error']:
+                LOG.error('   %s', status['error'])
+            with open(STATUS_FILE, 'w') as f:
+                json.dump(list(statuses.values()), f, indent=2)
+            f.close()
+        stager.release(status['case_id'], CLEANUP)
+
+    def failed(case_id, error):
+        return {'case_id': case_id, 'status': 'failed', 'failed_tiles': 0, 'failed_docs': 0, 'error': error,
+                'seconds': 0.0}
+
+    if CONCURRENCY > 1:
+        if WORKERS > 1:
+            LOG.warning('--workers is ignored when slides run concurrently')
+        slots = threading.BoundedSemaphore(CONCURRENCY)
+
+        def finished(case_id, future):
+            try:
+                status = future.result()
+            except BrokenProcessPool as err:
+                # The slide's worker died (e.g. a crash in OpenSlide or the OOM killer)
+                status = failed(case_id, 'BrokenProcessPool: {}'.format(err))
+            record(status)
+            slots.release()
+
+        def new_pool():
+            # Unlike multiprocessing.Pool, the executor fails the pending slides if a worker dies
+            return ProcessPoolExecutor(CONCURRENCY, mp_context=multiprocessing.get_context('fork'),
+                                       initializer=init_batch_worker)
+
+        pools = [new_pool()]
+        try:
+            for case_id in case_ids:
+                error = stager.wait(case_id)
+                if error:
+                    record(failed(case_id, error))
+                    continue
+                slots.acquire()
+                try:
+                    future = pools[-1].submit(run_batch_slide, case_id, True, stager.seconds[case_id])
+                except BrokenProcessPool:
+                    # A dead worker broke the pool: carry on with a new one
+                    pools.append(new_pool())
+                    future = pools[-1].submit(run_batch_slide, case_id, True, stager.seconds[case_id])
+                future.add_done_callback(lambda done, case_id=case_id: finished(case_id, done))
+        finally:
+            for pool in pools:
+                pool.shutdown()
+    else:
+        connect_db()
+        for case_id in case_ids:
+            error = stager.wait(case_id)
+            if error:
+                record(failed(case_id, error))
+            else:
+                record(run_batch_slide(case_id, True, stager.seconds[case_id]))
+        CLIENT.close()
+
+    done = sum(1 for status in statuses.values() if status['status'] == 'done')
+    LOG.info('Batch complete: %s of %s slides done, status in %s', done, len(case_ids), STATUS_FILE)
+    return list(statuses.values())
+
+
+def configure(args):
+    """
+    Set the run-wide settings from the parsed arguments.
+    :param args:
+    :return:
+    """
+    global USER_NAME, PATCH_SIZES, DB_HOST, READ_MODE, STAIN_ENGINE, STAIN_DTYPE, WORKERS, RESUME, \
+        STATS_LEVEL, STATS_MPP, STATS_CHECK, PERCENTILES, MIN_TISSUE, BLANK_PATCHES, TISSUE_DOWNSAMPLE, \
+        AREA_MODE, TUMOR_CLIP, TUMOR_OVERLAP, TUMOR_MASK_SUBDIV, MARKUP_CACHE_DIR, OFFLINE_MARKUPS, \
+        MANIFEST_THREADS, FLOAT32, CACHE_DIR, DB_BATCH_SIZE, DB_FLUSH_INTERVAL, CONCURRENCY, STATUS_FILE, \
+        RSYNC_JOBS, PREFETCH, MAX_STAGED_GB, CLEANUP, METRICS_FILE
+    USER_NAME = args["user_name"]
+    PATCH_SIZES = args["patch_size"]
+    DB_HOST = args["db_host"]
+    READ_MODE = args["read_mode"]
+    STAIN_ENGINE = args["stain_engine"]
+    STAIN_DTYPE = np.dtype(args["stain_dtype"])
+    WORKERS = args["workers"]
+    RESUME = args["resume"]
+    STATS_LEVEL = args["stats_level"]
+    STATS_MPP = args["stats_mpp"]
+    STATS_CHECK = args["stats_check"]
+    MIN_TISSUE = args["min_tissue"]
+    BLANK_PATCHES = args["blank_patches"]
+    TISSUE_DOWNSAMPLE = args["tissue_downsample"]
+    PERCENTILES = args["percentiles"]
+    AREA_MODE = args["area_mode"]
+    TUMOR_CLIP = args["tumor_clip"]
+    TUMOR_OVERLAP = args["tumor_overlap"]
+    TUMOR_MASK_SUBDIV = args["tumor_mask_subdiv"]
+    MARKUP_CACHE_DIR = args["markup_cache_dir"] or os.path.join(WORK_DIR, 'markup_cache')
+    OFFLINE_MARKUPS = args["offline_markups"]
+    MANIFEST_THREADS = args["manifest_threads"]
+    FLOAT32 = args["float32"]
+    FEATURE_DTYPES.clear()
+    CACHE_DIR = None if args["no_cache"] else (args["cache_dir"] or os.path.join(WORK_DIR, 'feature_cache'))
+    DB_BATCH_SIZE = args["db_batch_size"]
+    DB_FLUSH_INTERVAL = args["db_flush_interval"]
+    CONCURRENCY = args["concurrency"]
+    STATUS_FILE = args["status_file"] or os.path.join(WORK_DIR, 'batch_status.json')
+    RSYNC_JOBS = args["rsync_jobs"]
+    PREFETCH = args["prefetch"]
+    MAX_STAGED_GB = args["max_staged_gb"]
+    CLEANUP = args["cleanup"]
+    METRICS_FILE = args["metrics_file"]
+
+
+def main():
+    # construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-s", "--slide_name", help="svs image name")
+    ap.add_argument("-u", "--user_name", help="user who identified tumor regions")
+    ap.add_argument("-b", "--db_host", help="database host")
+    ap.add_argument("-p", "--patch_size", type=int, nargs='+',
+                    help="patch size; several sizes are computed in one pass, e.g. -p 256 512 1024")
+    ap.add_argument("--read_mode", choices=['tile', 'patch'], default='tile',
+                    help="decode each tile once and slice patches from it, or read every patch separately")
+    ap.add_argument("--stain_engine", choices=['lut', 'skimage'], default='lut',
+                    help="HED conversion through an optical density lookup table, or skimage separate_stains")
+    ap.add_argument("--stain_dtype", choices=['float64', 'float32'], default='float64',
+                    help="float type of the lookup table stain conversion")
+    ap.add_argument("--workers", type=int, default=1, help="number of processes computing tiles in parallel")
+    ap.add_argument("--stats_level", type=int, default=0,
+                    help="pyramid level the grayscale/hematoxylin statistics are read from")
+    ap.add_argument("--stats_mpp", type=float,
+                    help="read the grayscale/hematoxylin statistics from the level closest to this MPP")
+    ap.add_argument("--stats_check", type=int, default=1,
+                    help="with --stats_level/--stats_mpp, compare this many tiles against level 0")
+    ap.add_argument("--min_tissue", type=float,
+                    help="tissue fraction (0-1) below which a patch is blank, from a downsampled view of each tile")
+    ap.add_argument("--blank_patches", choices=['skip', 'flag'], default='skip',
+                    help="with --min_tissue, drop blank patches or write them with blank: true")
+    ap.add_argument("--tissue_downsample", type=int, default=16,
+                    help="downsample factor of the --min_tissue tissue map")
+    ap.add_argument("--percentiles", type=int, nargs='+', default=None,
+                    help="grayscale and hematoxylin percentiles to store in each patch document")
+    ap.add_argument("--area_mode", choices=['vector', 'raster', 'compare'], default='vector',
+                    help="nucleus_area from exact polygon intersections, from a rasterized tile mask, "
+                         "or both (vector is stored, raster alongside, and a comparison report is written)")
+    ap.add_argument("--tumor_clip", action="store_true", help="skip patches outside every tumor outline")
+    ap.add_argument("--tumor_overlap", action="store_true", help="record each patch's tumor overlap fraction")
+    ap.add_argument("--tumor_mask_subdiv", type=int, default=8,
+                    help="tumor mask cells per patch side, for --tumor_clip/--tumor_overlap")
+    ap.add_argument("--markup_cache_dir", help="local tumor markup cache (default WORK_DIR/markup_cache)")
+    ap.add_argument("--offline_markups", action="store_true",
+                    help="use cached tumor markups without querying the database")
+    ap.add_argument("--manifest_threads", type=int, default=8, help="threads reading the per-tile JSON files")
+    ap.add_argument("--float32", action="store_true", help="load float feature columns as float32")
+    ap.add_argument("--cache_dir", help="parsed feature cache (default WORK_DIR/feature_cache)")
+    ap.add_argument("--no_cache", action="store_true", help="always parse the feature CSVs")
+    ap.add_argument("--resume", action="store_true",
+                    help="skip the tiles a previous run of this slide checkpointed as written")
+    ap.add_argument("--db_batch_size", type=int, default=1000, help="patch documents per database write")
+    ap.add_argument("--db_flush_interval", type=float, default=30.0, help="max seconds between database writes")
+    ap.add_argument("--log_level", choices=['debug', 'info', 'warning', 'error'], default='info',
+                    help="logging verbosity; debug adds a line per tile")
+    ap.add_argument("--metrics_file",
+                    help="append per-slide stage timings, counts and peak memory to this file (.csv, else JSON lines)")
+    ap.add_argument("--batch", action="store_true",
+                    help="run several slides: those in --case_list, or every slide in config/image_path.list")
+    ap.add_argument("--case_list", help="file with one case ID per line, for --batch")
+    ap.add_argument("--concurrency", type=int, default=1, help="number of slides processed at once, for --batch")
+    ap.add_argument("--status_file", help="per-slide status JSON for --batch (default WORK_DIR/batch_status.json)")
+    ap.add_argument("--rsync_jobs", type=int, default=4, help="number of feature subfolders copied in parallel")
+    ap.add_argument("--prefetch", type=int, default=1, help="number of slides staged ahead, for --batch")
+    ap.add_argument("--max_staged_gb", type=float,
+                    help="don't stage more slides while WORK_DIR holds more than this, for --batch")
+    ap.add_argument("--cleanup", action="store_true", help="delete each slide's staged data once done, for --batch")
+    args = vars(ap.parse_args())
+    logging.basicConfig(level=getattr(logging, args["log_level"].upper()), stream=sys.stdout,
+                        format='%(asctime)s %(levelname)s %(processName)s %(message)s')
+    LOG.debug('%s', args)
+
+    if not len(sys.argv) > 1:
+        program_name = sys.argv[0]
+        lst = ['python', program_name, '-h']
+        subprocess.call(lst)  # Show help
+        exit(1)
+
+    configure(args)
+
+    if args["batch"]:
+        statuses = run_batch(get_batch_cases(args["case_list"]))
+        exit(0 if all(status['status'] == 'done' for status in statuses) else 1)
+
+    # Connect to MongoDB
+    connect_db()
+
+    failed_tiles, failed_docs = process_slide(args["slide_name"])
+
+    CLIENT.close()
+
+    exit(1 if failed_tiles or failed_docs else 0)
+
+
 # constant variables
+POLYGON_BRACKETS = str.maketrans('', '', '[]')
+# Tile position in data file names, e.g. ..._x4000_y200-features.csv
+TILE_KEY_RE = re.compile(r'(?<![0-9])x([0-9]+)_y([0-9]+)(?![0-9])')
+# CSV column -> mongo doc field prefix, for the *_segment_mean/*_segment_std fields
+SEGMENT_FEATURES = [('Flatness', 'flatness'), ('Perimeter', 'perimeter'), ('Circularity', 'circularity'),
+                    ('r_GradientMean', 'r_GradientMean'), ('b_GradientMean', 'b_GradientMean'),
+                    ('r_cytoIntensityMean', 'r_cytoIntensityMean'), ('b_cytoIntensityMean', 'b_cytoIntensityMean'),
+                    ('Elongation', 'elongation')]
+# Integer fields of the tile manifest, see build_tile_manifest
+TILE_MANIFEST_FIELDS = [('tile_minx', np.int64), ('tile_miny', np.int64), ('tile_width', np.int64),
+                        ('tile_height', np.int64), ('image_width', np.int64), ('image_height', np.int64)]
+# Fields identifying a patch document, for upserts
+PATCH_KEY = ['case_id', 'patch_size', 'patch_min_x_pixel', 'patch_min_y_pixel', 'stats_level']
+# Percentiles reported by tile_operations unless --percentiles is given
+DEFAULT_PERCENTILES = [10, 25, 50, 75, 90]
+# Tumor mask value of a cell fully inside a tumor outline, see build_tumor_mask
+TUMOR_MASK_UNIT = 1 << 16
+# Pipeline stages and counters in the per-slide metrics, see Metrics.report
+METRIC_STAGES = ['staging', 'manifest', 'tumor_filter', 'csv_load', 'polygon_parse', 'feature_cache',
+                 'tissue_filter', 'geometry', 'slide_read', 'stain', 'patch_stats', 'db_write']
+METRIC_COUNTS = ['tiles', 'tiles_failed', 'patches', 'nuclei', 'pixels_read', 'docs_written']
+LOG = logging.getLogger('myscript')
+# *features.csv columns the patch results are computed from
+FEATURE_COLUMNS = ['Perimeter', 'Flatness', 'Circularity', 'r_GradientMean', 'b_GradientMean',
+                   'b_cytoIntensityMean', 'r_cytoIntensityMean', 'r_IntensityMean', 'r_cytoGradientMean',
+                   'Elongation', 'Polygon']
 WORK_DIR = "/data1/tdiprima/dataset"
 DATA_FILE_FOLDER = "nfs004:/data/shared/bwang/composite_dataset"
 SVS_IMAGE_FOLDER = "nfs001:/data/shared/tcga_analysis/seer_data/images"
-
-# construct the argument parser and parse the arguments
-ap = argparse.ArgumentParser()
-ap.add_argument("-s", "--slide_name", help="svs image name")
-ap.add_argument("-u", "--user_name", help="user who identified tumor regions")
-ap.add_argument("-b", "--db_host", help="database host")
-ap.add_argument("-p", "--patch_size", type=int, help="patch size")
-args = vars(ap.parse_args())
-print(args)
-
-if not len(sys.argv) > 1:
-    program_name = sys.argv[0]
-    lst = ['python', program_name, '-h']
-    subprocess.call(lst)  # Show help
-    exit(1)
-
-CASE_ID = args["slide_name"]
-USER_NAME = args["user_name"]
-PATCH_SIZE = args["patch_size"]
-DB_HOST = args["db_host"]
-
-SLIDE_DIR = os.path.join(WORK_DIR, CASE_ID) + os.sep
-DATA_FILE_SUBFOLDERS = get_file_list(CASE_ID, 'config/data_file_path.list')
-# print('DATA_FILE_SUBFOLDERS', DATA_FILE_SUBFOLDERS)
-
-# Fetch data.
-assure_path_exists(SLIDE_DIR)
-copy_src_data(SLIDE_DIR)
-
-mpp_x, mpp_y, image_width, image_height = get_image_metadata()
-patch_polygon_area = PATCH_SIZE * PATCH_SIZE * mpp_x * mpp_y
-print('patch_polygon_area', patch_polygon_area)
-
-# Find what the pathologist circled as tumor.
-tumor_mark_list = get_tumor_markup(USER_NAME)
-# print('tumor_mark_list', len(tumor_mark_list))
-
-# List of Tumor polygons
-tumor_poly_list = markup_to_polygons(tumor_mark_list)
-# print('tumor_poly_list', len(tumor_poly_list))
-
-# Fetch list of data files
-JSON_FILES, CSV_FILES = get_data_files()
-
-# Identify only the files within the tumor regions
-jfile_objs = get_poly_within(JSON_FILES, tumor_poly_list)
-print('get_poly_within len: ', len(jfile_objs))
-
-# Get data
-csv_data = aggregate_data(jfile_objs, CSV_FILES)
-print('csv_data len: ', len(csv_data))
-
-# Connect to MongoDB
 coll_name = 'test2_features_td'
-client = {}
-try:
-    client = mongodb_connect('mongodb://' + DB_HOST + ':27017')
-    client.server_info()  # force connection, trigger error to be caught
-    DB = client.quip_comp
-except Exception as e:
-    print('Connection error: ', e)
-    exit(1)
-
-# Calculate
-calculate(csv_data)
-
-client.close()
-
-exit(0)
+CONFIG_LINES = {}
+
+# run-wide settings, see configure()
+USER_NAME = None
+PATCH_SIZES = None
+DB_HOST = None
+READ_MODE = 'tile'
+STAIN_ENGINE = 'lut'
+STAIN_DTYPE = np.dtype('float64')
+HED_LUTS = {}
+WORKERS = 1
+TILE_DATA = {}
+WORKER_SLIDE = None
+RESUME = False
+STATS_LEVEL = 0
+STATS_MPP = None
+STATS_CHECK = 1
+MIN_TISSUE = None
+BLANK_PATCHES = 'skip'
+TISSUE_DOWNSAMPLE = 16
+PERCENTILES = None
+AREA_MODE = 'vector'
+TUMOR_CLIP = False
+TUMOR_OVERLAP = False
+TUMOR_MASK_SUBDIV = 8
+MARKUP_CACHE_DIR = None
+OFFLINE_MARKUPS = False
+MANIFEST_THREADS = 8
+FLOAT32 = False
+FEATURE_DTYPES = {}
+CACHE_DIR = None
+DB_BATCH_SIZE = 1000
+DB_FLUSH_INTERVAL = 30.0
+WRITERS = {}
+CLIENT = None
+DB = None
+CONCURRENCY = 1
+STATUS_FILE = None
+RSYNC_JOBS = 4
+PREFETCH = 1
+MAX_STAGED_GB = None
+CLEANUP = False
+METRICS_FILE = None
+METRICS = Metrics()
+
+# per-slide state, see process_slide()
+CASE_ID = None
+SLIDE_DIR = None
+DATA_FILE_SUBFOLDERS = []
+mpp_x = mpp_y = image_width = image_height = patch_polygon_area = None
+TUMOR_MASK = None
+
+if __name__ == '__main__':
+    main()